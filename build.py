@@ -6,6 +6,9 @@ from optparse import OptionParser, OptionGroup
 from collections import OrderedDict
 from copy import deepcopy
 import csv
+from array import array
+from math import isnan, nan
+import multiprocessing
 import gcmstoolbox
 
 
@@ -32,26 +35,34 @@ def main():
   parser.add_option("-c", "--cnumber",  help="Start number for component numbers", action="store", dest="c", type="int" , default=1)
   parser.add_option("-p", "--preserve", help="Preserve group numbers", action="store_true", dest="preserve", default=False)
   parser.add_option("-s", "--sum",      help="Calculate sumspectra with the N spectra with highest signal, 0 for all [default: 0]", action="store",  dest="n", type="int", default=0)
+  parser.add_option("-I", "--incremental", help="Only rebuild components of which the group or sum settings changed", action="store_true", dest="incremental", default=False)
+  parser.add_option("-j", "--jobs",     help="Number of parallel worker processes [default: 1]", action="store", dest="jobs", type="int", default=1)
 
+  group = OptionGroup(parser, "CONSENSUS SPECTRA", "Robust alternatives for the signal-weighted sumspectra, less sensitive to outlier spectra (e.g. co-elution).")
+  group.add_option("--consensus", help="Combine the spectra of a group by: sum|median|trimmed [default: sum]", action="store", dest="consensus", type="string", default="sum")
+  group.add_option("--trim",      help="Fraction of the lowest and of the highest intensities that is ignored by the trimmed mean [default: 0.1]", action="store", dest="trim", type="float", default=0.1)
+  group.add_option("--presence",  help="Minimal fraction of the spectra in which a m/z value must be present [default: 0]", action="store", dest="presence", type="float", default=0)
+  parser.add_option_group(group)
+
+  gcmstoolbox.profileOptions(parser)
+  
   (options, args) = parser.parse_args()
   
 
   ### ARGUMENTS
 
   cmd = " ".join(sys.argv)
+  gcmstoolbox.startProfile(options, cmd)
 
   if options.verbose: print("Processing arguments...")
   
   # check number of arguments
   if len(args) != 0: #exit without complaining
     print("\n!! Too many arguments")
-    exit()
+    exit(1)
   
   # check and read JSON input file
-  data = gcmstoolbox.openJSON(options.jsonin)
-  if data['info']['mode'] == 'spectra':
-    print("\n!! Cannot build components using ungrouped spectra.")
-    exit()
+  data = gcmstoolbox.openJSON(options.jsonin, options.jsonout)
   
   # json output 
   if options.jsonout == None: 
@@ -61,16 +72,68 @@ def main():
     print(" => JSON input file:  " + options.jsonin)
     print(" => JSON output file: " + options.jsonout + "\n")
 
+
+  ### BUILD COMPONENTS
+
+  try:
+    with gcmstoolbox.stage("build", unit="components") as record:
+      buildcomponents(data, options.c, options.preserve, options.n, options.incremental, options.jobs,
+                      options.consensus, options.trim, options.presence, verbose=options.verbose, progress=True)
+      record['items'] = len(data['components'])
+  except gcmstoolbox.GCMSError as e:
+    print("\n!! " + str(e))
+    exit(1)
+
+
+   ### SAVE OUTPUT JSON
+   
+  print("\nSaving data...")
+  
+  data["info"]["cmds"].append(cmd)
+  gcmstoolbox.saveJSON(data, options.jsonout)     # backup and safe json
+  
+  print(" => Wrote " + options.jsonout + "\n")
+  gcmstoolbox.stopProfile()
+  exit()
+  
+
+  
+def buildcomponents(data, c=1, preserve=False, n=0, incremental=False, jobs=1, consensus="sum", trim=0.1, presence=0, verbose=False, progress=False):
+  # build the component spectra (data['components']) from the groups that pass the active filters:
+  #   c:           start number for the component numbers
+  #   preserve:    use the group numbers as component numbers
+  #   n:           make sumspectra with the n spectra with highest signal, 0 for all
+  #   incremental: only rebuild the components of which the group or sum settings changed
+  #   jobs:        number of parallel worker processes
+  #   consensus:   sum|median|trimmed, with trim and presence (see gcmstoolbox.consensusspectrum)
+  # returns the number of reused components (progress: show the progress on the terminal)
+  if data['info']['mode'] == 'spectra':
+    raise gcmstoolbox.GCMSError("Cannot build components using ungrouped spectra.")
+
+  # number of worker processes
+  if jobs < 1:
+    raise gcmstoolbox.GCMSError("The number of jobs (-j) must be at least 1.")
+
+  # consensus spectra
+  consensus = consensus.lower()
+  if consensus not in ["sum", "median", "trimmed"]:
+    raise gcmstoolbox.GCMSError("Unknown consensus mode (possible modes are 'sum', 'median' and 'trimmed')")
+  if not (0 <= trim < 0.5):
+    raise gcmstoolbox.GCMSError("The trim fraction must be at least 0 and smaller than 0.5")
+  if not (0 <= presence <= 1):
+    raise gcmstoolbox.GCMSError("The presence fraction must be between 0 and 1")
+
   # preserve and c number flags cannot be used together
-  if options.preserve and (options.c != 1):
-    print("\n!! The options -c (--cnumber) and -p (--preserve) cannot be used together.")
-    exit()
+  if preserve and (c != 1):
+    raise gcmstoolbox.GCMSError("The options -c (--cnumber) and -p (--preserve) cannot be used together.")
+
+  bar = progress and not verbose   # progress bars
 
 
   ### APPLY ACTIVE FILTERS
   
-  print("\nApply filters...")
-  if not options.verbose: 
+  if progress or verbose: print("\nApply filters...")
+  if bar: 
     i = 0
     j = len(data['filters'])
     gcmstoolbox.printProgress(i, j)
@@ -79,148 +142,252 @@ def main():
   for id, f in data['filters'].items():
     if f['active']:
       out.update(f['out'])
-      if options.verbose: print(" - add " + id)
-    if not options.verbose: 
+      if verbose: print(" - add " + id)
+    if bar: 
       i += 1
       gcmstoolbox.printProgress(i, j)
 
 
   ### BUILD COMPONENTS
 
-  print("\nBuild components...")
+  if progress or verbose: print("\nBuild components...")
   
-  i = 0  # we'll use this both for the progress bar and for the component number (i + options.c, if options.preserve is false)
+  i = 0  # progress bar
   #report = []
-  data['components'] = OrderedDict()
   
-  # to sort components on RI, we'll make an intermediary groups dict (ri: groupname)
-  groups = []
-  ris = []
-  for gid, group in data['groups'].items():
-    if gid not in out: #apply filters
-      if 'minRI' in group:
-        # find position
-        gri = float(group['minRI'])
-        pos = 0
-        for r in ris:
-          if r <= gri:
-            pos += 1 
-          else: 
-            break
-        
-        # add to groups and ris
-        groups.insert(pos, gid)
-        ris.insert(pos, gri)
-      else: #group without minRI: add to the back of the groups list
-        groups.append(gid)
+  # the groups that pass the filters as a table of integer ids, minRI and member spectrum indices;
+  # a stable sort on minRI gives the component order (groups without minRI go to the back)
+  names = list(data['spectra'].keys())
+  gids, ids, minri, members = grouptable(data['groups'], out, names, preserve)
+  order = sorted(range(len(gids)), key=lambda k: (isnan(minri[k]), minri[k]))
+
+  # components of a previous build can be reused if the group membership and the sum settings
+  # did not change; only the numbering (DB# and name prefix) is then updated
+  settings = OrderedDict([('sum', n), ('consensus', consensus), ('trim', trim), ('presence', presence)])
+  hashes = OrderedDict((gids[k], gcmstoolbox.grouphash(names[s] for s in members[k])) for k in order)
+  reuse = {}
+  if incremental:
+    reuse = reusable(data, hashes, settings)
+    if progress or verbose: print("  - reusing " + str(len(reuse)) + " of " + str(len(order)) + " components")
+  data['components'] = OrderedDict()
+  data['build'] = OrderedDict([('settings', settings), ('groups', OrderedDict())])
 
   # init progress bar
-  if not options.verbose: 
-    j = len(groups)
+  if bar: 
+    j = len(order)
     gcmstoolbox.printProgress(i, j)
 
   # build components from the groups
-  for g in groups:
-    # init
-    group = data['groups'][g]
-    groupspectra = []
-    
+  # (each task is: component number, group name, spectrum indices of the group)
+  tasks = []
+  numbers = array('l')
+  for k in order:
     # group or component numbering:
-    if not options.preserve: c = i + options.c
-    else:                    c = int(g.replace('G', ''))
-  
-    # collect the spectra
-    for s in group['spectra']:
-      #if not options.elinc: csvSpectra.append(s)
-      groupspectra.append(data['spectra'][s])
-  
-    # if more than one spectrum, make sumspectrum
-    if len(groupspectra) > 1:
-      sp = gcmstoolbox.sumspectrum(*groupspectra, highest=options.n)
-    else:
-      sp = deepcopy(groupspectra[0])
-      
-    # rebuild the spectra metadata (and change for single spectra things)
-    name = "C{} RI{}".format(str(c), str(round(float(sp['RI']))))
-    sp['DB#'] = str(c)
-    sp['Group'] = g
-    sp['Spectra'] = group['spectra']
-    
-    for item in ["Source", "Sample", "Resin", "AAdays", "Color", "PyTemp"]:
-      values = set()
-      for s in groupspectra:
-        if item in s:
-          values.add(s[item])
-      
-      if len(values) > 0:
-        # store as list in component
-        sp[item] = sorted(values)
-
-        # and add it to the component name
-        if item == "AAdays":
-          valuesInt = [ int(x) for x in values ]
-          valuesInt = sorted(valuesInt)
-          # condense the list of AAdays into sequences (0,2,4,8,32 becomes 0-8,32)
-          seq = []
-          days = [0, 2, 4, 8, 16, 32, 64]
-          k = 0
-          for low in days:
-            if low in valuesInt:        #lower limit of sequence
-              seq.insert(k, str(low))
-              valuesInt.remove(low)
-              found = False
-              for high in days:   
-                if high > low:
-                  if high in valuesInt: #higher limit of sequence
-                    found = high
-                    valuesInt.remove(high)
-                  else:
-                    break
-              if found: seq[k] += "-" + str(found)
-              k += 1
-          # add possible AAdays values other than 0,2,4,8...
-          for x in valuesInt: seq.append(str(x)) 
-          name += " " + ",".join(seq) + "d"
-        elif item == "Color":
-          name += " " + "/".join(sorted(values))
-        elif item == "Source":
-          pass
-        elif item == "Sample":
-          pass
-        else:
-          name += " " + "-".join(sorted(values))
-
-    # crop name (longer names cause problems in Amdis)
-    name = name[:77]
-    
-    # add to data
-    data['components'][name] = sp
-    
-    # add a "link" to the group data
-    # (used to include sumspectrum if a group library is exported) 
-    # commented out, because this data remains present when components are built multiple times --> becomes ambiguous!!
-    #data['groups'][g]['component'] = name
+    if not preserve: number = len(numbers) + c
+    else:            number = ids[k]
+    numbers.append(number)
+    if gids[k] not in reuse:
+      tasks.append((number, gids[k], members[k]))
 
-    i += 1
-    
-    # update progress bar
-    if options.verbose:
-      print("  - " + name)
-    else:
-      gcmstoolbox.printProgress(i, j)
+  spectra = list(data['spectra'].values())
+  # the metadata of the components is collected on integer codes of the values (per spectrum index)
+  categories = gcmstoolbox.categorycodes(spectra, metadata)
+  if jobs > 1:
+    # the components are independent: build them in worker processes that each hold a copy
+    # of the (read-only) spectra; imap returns the results in the order of the tasks (RI)
+    # (only the spectra of the groups to build are copied)
+    needed = [None] * len(spectra)
+    for task in tasks:
+      for s in task[2]:
+        needed[s] = spectra[s]
+    spectra = needed
+    pool = multiprocessing.Pool(jobs, initializer=initworker, initargs=(names, spectra, settings, categories))
+    results = pool.imap(buildworker, tasks, chunksize=max(1, len(tasks) // (jobs * 16)))
+  else:
+    pool = None
+    results = (buildcomponent(number, g, m, names, spectra, n, consensus, trim, presence, categories)
+               for number, g, m in tasks)
 
+  try:
+    for k, number in zip(order, numbers):
+      g = gids[k]
+      if g in reuse:
+        label, sp = reuse[g]
+        sp['DB#'] = str(number)
+      else:
+        label, sp = next(results)
+      name = componentname(number, label)
 
-   ### SAVE OUTPUT JSON
-   
-  print("\nSaving data...")
+      # add to data
+      data['components'][name] = sp
+      # and to the group -> component index of this build (used to include the 
+      # sumspectrum if a group library is exported); it is replaced as a whole on every build, 
+      # and the hash tells whether a group was changed afterwards (see export.componentindex)
+      data['build']['groups'][g] = OrderedDict([('hash', hashes[g]), ('label', label), ('component', name)])
+
+      i += 1
+    
+      # update progress bar
+      if verbose:
+        print("  - " + name + ("  [reused]" if g in reuse else ""))
+      elif bar:
+        gcmstoolbox.printProgress(i, j)
+
+  finally:
+    if pool is not None:
+      pool.close()
+      pool.join()
   
   data['info']['mode'] = "components"
-  data["info"]["cmds"].append(cmd)
-  gcmstoolbox.saveJSON(data, options.jsonout)     # backup and safe json
-  
-  print(" => Wrote " + options.jsonout + "\n")
-  exit()
+  return len(reuse)
+
+
+
+# the metadata fields that are collected in the components (the values of the group spectra)
+metadata = ["Source", "Sample", "Resin", "AAdays", "Color", "PyTemp"]
+
+def buildcomponent(c, g, members, names, spectra, highest=False, consensus="sum", trim=0.1, presence=0, categories=None):
+  # build component number c from the spectra of group g (members: indices in names and spectra)
+  # categories: the coded metadata of the spectra (gcmstoolbox.categorycodes(spectra, metadata))
+  # returns the component label (its name without the number, see componentname) and spectrum
+  if categories is None:
+    categories = gcmstoolbox.categorycodes([spectra[s] for s in members], metadata)
+    index = range(len(members))
+  else:
+    index = members
+  tables, codes = categories
+  groupspectra = [spectra[s] for s in members]
+
+  # if more than one spectrum, make sumspectrum (or robust consensus spectrum)
+  if len(groupspectra) > 1:
+    if (consensus == "sum") and (presence == 0):
+      sp = gcmstoolbox.sumspectrum(*groupspectra, highest=highest)
+    else:
+      sp = gcmstoolbox.consensusspectrum(*groupspectra, highest=highest, mode=consensus, trim=trim, presence=presence)
+  else:
+    sp = deepcopy(groupspectra[0])
+    
+  # rebuild the spectra metadata (and change for single spectra things)
+  name = "RI{}".format(str(round(float(sp['RI']))))
+  sp['DB#'] = str(c)
+  sp['Group'] = g
+  sp['Spectra'] = [names[s] for s in members]
   
+  for f, item in enumerate(metadata):
+    values = set(codes[s][f] for s in index)
+    values.discard(-1)
     
+    if len(values) > 0:
+      values = [tables[item][v] for v in values]
+      # store as list in component
+      sp[item] = sorted(values)
+
+      # and add it to the component name
+      if item == "AAdays":
+        name += " " + condensedays(values) + "d"
+      elif item == "Color":
+        name += " " + "/".join(sorted(values))
+      elif item == "Source":
+        pass
+      elif item == "Sample":
+        pass
+      else:
+        name += " " + "-".join(sorted(values))
+
+  return name, sp
+
+
+
+def componentname(c, label):
+  # crop name (longer names cause problems in Amdis)
+  return "C{} {}".format(str(c), label)[:77]
+
+
+
+def reusable(data, hashes, settings):
+  # components of the previous build (group -> label and spectrum) that are still valid
+  reuse = {}
+  if ('components' not in data) or ('build' not in data) or (data['build']['settings'] != settings):
+    return reuse
+  previous = data['build']['groups']
+  for sp in data['components'].values():
+    g = sp['Group']
+    if (g in hashes) and (g in previous) and (previous[g]['hash'] == hashes[g]):
+      reuse[g] = (previous[g]['label'], sp)
+  return reuse
+
+
+
+def condensedays(values):
+  # condense the list of AAdays into sequences (0,2,4,8,32 becomes 0-8,32)
+  valuesInt = [ int(x) for x in values ]
+  valuesInt = sorted(valuesInt)
+  seq = []
+  days = [0, 2, 4, 8, 16, 32, 64]
+  k = 0
+  for low in days:
+    if low in valuesInt:        #lower limit of sequence
+      seq.insert(k, str(low))
+      valuesInt.remove(low)
+      found = False
+      for high in days:   
+        if high > low:
+          if high in valuesInt: #higher limit of sequence
+            found = high
+            valuesInt.remove(high)
+          else:
+            break
+      if found: seq[k] += "-" + str(found)
+      k += 1
+  # add possible AAdays values other than 0,2,4,8...
+  for x in valuesInt: seq.append(str(x)) 
+  return ",".join(seq)
+
+
+
+def grouptable(groups, out, names, preserve=False):
+  # table of the groups that are not filtered out, as parallel arrays:
+  #   gids:    group names
+  #   ids:     group numbers (only if preserve, to number the components after their groups)
+  #   minri:   minimal RI of the group (NaN if unknown)
+  #   members: for each group, the indices of its spectra in names
+  index = {s: k for k, s in enumerate(names)}
+  gids = []
+  ids = array('l')
+  minri = array('d')
+  members = []
+  for gid, group in groups.items():
+    if gid not in out: #apply filters
+      gids.append(gid)
+      if preserve:
+        if not gid[1:].isdigit():
+          raise gcmstoolbox.GCMSError("Cannot preserve the group numbers (-p): " + gid + " is not numbered.")
+        ids.append(int(gid[1:]))
+      minri.append(float(group['minRI']) if 'minRI' in group else nan)
+      members.append(array('l', (index[s] for s in group['spectra'])))
+  return gids, ids, minri, members
+
+
+
+# worker processes for parallel builds (--jobs): the spectra are passed once per worker
+workernames = None
+workerspectra = None
+workersettings = None
+workercategories = None
+
+def initworker(names, spectra, settings, categories):
+  global workernames, workerspectra, workersettings, workercategories
+  workernames = names
+  workerspectra = spectra
+  workersettings = settings
+  workercategories = categories
+
+def buildworker(task):
+  c, g, members = task
+  s = workersettings
+  return buildcomponent(c, g, members, workernames, workerspectra, s['sum'], s['consensus'], s['trim'], s['presence'], workercategories)
+
+
+
 if __name__ == "__main__":
   main()
@@ -5,10 +5,21 @@ import sys
 import os
 from collections import OrderedDict
 from glob import glob
+import csv
+import json
+import struct
+import locale
+import multiprocessing
+from array import array
+from math import inf, nan
 from optparse import OptionParser, OptionGroup
 import gcmstoolbox
 
 
+# number of spectra that are formatted and written at once
+chunksize = 1000
+
+
 def main():
   print("\n*******************************************************************************")
   print(  "* GCMStoolbox - a set of tools for GC-MS data analysis                        *")
@@ -24,7 +35,7 @@ def main():
 
   ### OPTIONPARSER
   
-  usage = "usage: %prog [options] MSP_FILE"
+  usage = "usage: %prog [options] MSP_FILE\n       %prog -f columnar [options] OUTPUT_DIR"
   
   parser = OptionParser(usage, version="GCMStoolbox version " + gcmstoolbox.version + " (" + gcmstoolbox.date + ")\n")
   parser.add_option("-v", "--verbose", help="Be very verbose [not default]", action="store_true", dest="verbose", default=False)
@@ -32,27 +43,51 @@ def main():
   parser.add_option("-o", "--jsonout", help="JSON output file name [default: same as JSON input file]", action="store", dest="jsonout", type="string")
   parser.add_option("-m", "--mode",    help="Mode: auto|spectra|group|components [default:auto]", action="store", dest="mode", type="string", default="auto")
   parser.add_option("-g", "--group",   help="Group numbers to export in group mode; multiple instances can be defined", action="append", dest="group", type="string")
+  parser.add_option("-j", "--jobs",    help="Number of parallel worker processes [default: 1]", action="store", dest="jobs", type="int", default=1)
+  parser.add_option("-f", "--format",  help="Output format: msp|columnar [default: msp]", action="store", dest="format", type="string", default="msp")
+  
+  group = OptionGroup(parser, "COLUMNAR", "Write NumPy .npy arrays (that can be memory-mapped) into OUTPUT_DIR: spectrum metadata columns, and in components mode the component x m/z intensity matrix and the component x category abundance (mean IS) matrix. OUTPUT_DIR/columns.json describes the arrays.")
+  group.add_option("--categories", help="Categories of the abundance matrix (eg. Source, Sample, AAdays, Resin...) [default: Source]", action="store", dest="categories", type="string", default="Source")
+  parser.add_option_group(group)
+  
+  group = OptionGroup(parser, "SHARDS", "Split the library into several MSP files (MSP_FILE-001.msp, MSP_FILE-002.msp...), with a manifest (MSP_FILE-manifest.csv) of the spectra in each shard. The records are identical to those of an unsplit export, so the shards can be searched separately and their results concatenated.")
+  group.add_option("--shards",    help="Split into N shards of (nearly) equal numbers of spectra", action="store", dest="shards", type="int", default=0)
+  group.add_option("--shardby",   help="Split in export order or in RI order: order|ri [default: order]", action="store", dest="shardby", type="string", default="order")
+  group.add_option("--shardsize", help="Split (in export order) into shards of at most SHARDSIZE MB", action="store", dest="shardsize", type="float", default=0)
+  parser.add_option_group(group)
+  
+  gcmstoolbox.profileOptions(parser)
   
   (options, args) = parser.parse_args()
 
   ### ARGUMENTS AND OPTIONS
   
   cmd = " ".join(sys.argv)
+  gcmstoolbox.startProfile(options, cmd)
   
   if options.verbose: print("Processing import files and options")
 
+  # output format
+  options.format = options.format.lower()
+  if options.format not in ["msp", "columnar"]:
+    print("  !! Unknown format (possible formats are 'msp' and 'columnar')\n")
+    exit(1)
+  if (options.format == "columnar") and ((options.shards > 0) or (options.shardsize > 0)):
+    print("  !! Shards can only be made in msp format\n")
+    exit(1)
+
   # check MSP output file
   if len(args) == 0:
     print("  !! No MSP file name given\n")
-    exit()
+    exit(1)
   elif len(args) != 1:
     print("  !! Too many arguments. Only one MSP file name can be created.\n")
-    exit()
+    exit(1)
   else:
     mspfile = args[0]
 
   # check and read JSON input file
-  data = gcmstoolbox.openJSON(options.jsonin)
+  data = gcmstoolbox.openJSON(options.jsonin, options.jsonout)
     
   # json output 
   if options.jsonout == None: 
@@ -64,164 +99,508 @@ def main():
     print(" => Output msp file:  " + mspfile + "\n")
 
 
-  ### MODE
+  # shards
+  options.shardby = options.shardby.lower()
+  if options.shardby not in ["order", "ri"]:
+    print("  !! Unknown shard order (possible orders are 'order' and 'ri')\n")
+    exit(1)
+  if (options.shards > 0) and (options.shardsize > 0):
+    print("  !! The options --shards and --shardsize cannot be used together\n")
+    exit(1)
+
+
+  ### MODE AND SPECTRA
   
-  if options.mode.lower().startswith('a'):
+  try:
+    mode, splist = exportlist(data, options.mode, options.group)
+    if (options.format == "columnar") and (mode == "group"):
+      raise gcmstoolbox.GCMSError("The columnar format is available in spectra and components mode")
+  except gcmstoolbox.GCMSError as e:
+    print("  !! " + str(e) + "\n")
+    exit(1)
+  
+  print("Mode: " + mode)
+    
+    
+  ### WRITE FILE
+  
+  print("\nProcessing mass spectra")
+  if mode == "group":
+    for g in options.group:
+      if 'G' + str(g) not in data['groups']:
+        print(" !! G" + str(g) + " was not found.")
+
+  with gcmstoolbox.stage("export " + options.format, len(splist), "spectra"):
+    if options.format == "columnar":
+      columns = writecolumnar(mspfile, data, mode, options.categories, options.verbose)
+      print("\n => Wrote {} arrays in {}\n".format(len(columns), mspfile))
+
+    elif (options.shards > 0) or (options.shardsize > 0):
+      # split into shards and write a manifest
+      if options.shardsize > 0:
+        manifest = writesizeshards(mspfile, splist, int(options.shardsize * 1024 * 1024), options.jobs, options.verbose, progress=True)
+      else:
+        manifest = writeshards(mspfile, splist, options.shards, options.shardby, options.jobs, options.verbose, progress=True)
+      manifestfile = writemanifest(mspfile, manifest)
+      
+      print("\n => Wrote {} shards and {}\n".format(manifest[-1][0] if len(manifest) > 0 else 0, manifestfile))
+      
+    else:
+      writemsp(mspfile, splist, options.jobs, options.verbose, progress=True)
+      print("\n => Wrote {}\n".format(mspfile))
+
+
+  ### TRACE IN JSON FILE
+  
+  # read-only command: the (possibly large) data file is not rewritten, the command is appended
+  # to its command history file instead; only a different JSON output file gets a full copy
+  if options.jsonout == options.jsonin:
+    print("\nPut a trace in the command history: " + options.jsonout + ".cmds\n")
+    gcmstoolbox.logCommand(options.jsonout, cmd)
+  else:
+    print("\nPut a trace in the JSON output file: " + options.jsonout + "\n")
+    data['info']['cmds'].append(cmd)                # put a trace in the data file
+    gcmstoolbox.saveJSON(data, options.jsonout)     # backup and safe json
+
+  gcmstoolbox.stopProfile()
+  exit()
+    
+  
+  
+  
+def exportlist(data, mode="auto", groups=None):
+  # the spectra to export in the given mode (auto|spectra|group|components); returns the mode
+  # (auto resolved) and the spectra (name -> spectrum); in group mode, these are the spectra of
+  # the given group numbers, each followed by its component (sumspectrum) if it was built
+  if mode.lower().startswith('a'):
     mode = data['info']['mode']
     if mode == 'filter': mode = 'group'
-  elif options.mode.lower().startswith('s'):
+  elif mode.lower().startswith('s'):
     mode = 'spectra'
-  elif options.mode.lower().startswith('g'):   
+  elif mode.lower().startswith('g'):   
     mode = 'group'
     if data['info']['mode'] == 'spectra':
-      print("  !! No groups defined - run groups.py first\n")
-      exit()
-    if len(options.group) == 0:
-      print("  !! Group mode requires at least one group (-g)\n")
-      exit()
-  elif options.mode.lower().startswith('c'):
+      raise gcmstoolbox.GCMSError("No groups defined - run groups.py first")
+    if not groups:
+      raise gcmstoolbox.GCMSError("Group mode requires at least one group (-g)")
+  elif mode.lower().startswith('c'):
     mode = 'components'
     if data['info']['mode'] != 'components':
-      print("  !! No components defined - run componentlib.py first\n")
-      exit()
+      raise gcmstoolbox.GCMSError("No components defined - run componentlib.py first")
   else:
-    print("  !! Unknown mode (possible modes are 'auto', 'spectra', 'group' and 'components'\n")
-    exit()
-  
-  print("Mode: " + mode)
-    
-    
-  ### WRITE FILE
-  
-  print("\nProcessing mass spectra")
+    raise gcmstoolbox.GCMSError("Unknown mode (possible modes are 'auto', 'spectra', 'group' and 'components'")
   
   # make list of spectra to be added
   splist = OrderedDict()
   if (mode == "spectra") or (mode == "components"):
     splist = data[mode]
   elif mode == "group":
-    for g in options.group:
+    index = componentindex(data, set('G' + str(g) for g in groups or []))
+    for g in groups or []:
       if 'G' + str(g) in data['groups']:
         # add original spectra to splist
         for s in data['groups']['G' + str(g)]['spectra']:
           splist[s] = data['spectra'][s]
         # if a component exists with a sumspectrum, add this.
-        if 'components' in data:
-          for c in data['components']:
-            if data['components'][c]['Group'] == 'G' + str(g):
-              splist[c] = data['components'][c]
-              break
-      else:
-        print(" !! G" + str(g) + " was not found.")
-  
+        c = index.get('G' + str(g))
+        if c is not None:
+          splist[c] = data['components'][c]
+  return mode, splist
+
+
+
+def writemsp(mspfile, splist, jobs=1, verbose=False, progress=False):
+  # write the spectra (name -> spectrum) into an MSP file (progress: show the progress on the terminal)
+  # the spectra are formatted in chunks, which are written in one go
+  # (with jobs > 1, the chunks are formatted by worker processes, and written in order)
+  items = list(splist.items())
+  chunks = [[(mspfile, name, sp) for name, sp in items[c:c+chunksize]] for c in range(0, len(items), chunksize)]
 
   with open(mspfile, "w") as fh:
     # init progress bar
-    if not options.verbose: 
+    if progress and not verbose: 
       j = 0
       k = len(splist)
       gcmstoolbox.printProgress(j, k)
+  
+    if jobs > 1:
+      pool = multiprocessing.Pool(jobs)
+      blocks = pool.imap(formatchunk, chunks)
+    else:
+      pool = None
+      blocks = (formatchunk(chunk) for chunk in chunks)
+  
+    try:
+      for chunk, block in zip(chunks, blocks):
+        fh.write(block)
     
-    for name, spectrum in splist.items():
-      writespectrum(fh, mspfile, name, spectrum, options.verbose)
-    
-      # adjust progress bar
-      if not options.verbose: 
-        j += 1
-        gcmstoolbox.printProgress(j, k)
+        # adjust progress bar
+        if verbose:
+          for fn, name, sp in chunk:
+            print("    - Write", name, "in output file")
+        elif progress:
+          j += len(chunk)
+          gcmstoolbox.printProgress(j, k)
 
-  print("\n => Wrote {}\n".format(mspfile))
+    finally:
+      if pool is not None:
+        pool.close()
+        pool.join()
 
 
-  ### TRACE IN JSON FILE
-  
-  print("\nPut a trace in the JSON output file: " + options.jsonout + "\n")
-  data = gcmstoolbox.openJSON(options.jsonin)     # reread the file to be sure we haven't accidentally messed up the data
-  data['info']['cmds'].append(" ".join(sys.argv)) # put a trace in the data file
-  gcmstoolbox.saveJSON(data, options.jsonout)     # backup and safe json
-   
-  exit()
-    
-  
-  
+
+def writemanifest(mspfile, manifest):
+  # write the manifest rows of the shards to MSP_FILE-manifest.csv; returns its file name
+  manifestfile = os.path.splitext(mspfile)[0] + "-manifest.csv"
+  with open(manifestfile, 'w', newline='') as fh:
+    mkmanifest = csv.writer(fh, dialect='excel')
+    mkmanifest.writerow(["shard", "file", "spectrum", "DB#", "RI"])
+    mkmanifest.writerows(manifest)
+  return manifestfile
+
+
+
+def componentindex(data, groups):
+  # group -> component name for the given groups, from the index of the last build (data['build'])
+  # an index entry is only used if its group still has the same spectra as when it was built
+  # (groups can be rebuilt afterwards by group.py); for data files built by older versions
+  # the index is made by scanning the components
+  index = {}
+  if 'components' not in data:
+    return index
   
+  if ('build' in data) and ('groups' in data['build']):
+    built = data['build']['groups']
+    for g in groups:
+      if (g in built) and (g in data['groups']) and (built[g]['component'] in data['components']):
+        if built[g]['hash'] == gcmstoolbox.grouphash(data['groups'][g]['spectra']):
+          index[g] = built[g]['component']
+  else:
+    for c, sp in data['components'].items():
+      if (sp['Group'] in groups) and (sp['Group'] not in index):
+        index[sp['Group']] = c
+  return index
+
+
+
 def writespectrum(fh, fn, name, sp, verbose = False):
-  # write the spectrum to the file handle line by line in NIST MSP format
-  # don't mind to much about the order of the lines; we start with Name, and end with NumPeaks and the spectral data
+  # write the spectrum to the file handle in NIST MSP format
+  if verbose:
+    print("    - Write", name, "in output file")
+  fh.write(formatspectrum(fn, name, sp))
+
+
+
+# fields that are written in the comments, and fields that are not written at all
+commentitems = ['Sample', 'Resin', 'AAdays', 'Color', 'PyTemp', 'OR', 'IS', 'RA', 'SN', 'dRI']
+skipitems = set(commentitems + ['Num Peaks', 'xydata', 'Spectra', 'Samples'])
 
-  # build comments, while removing fields that don't belong in the msp
-  comments = ""
-  items = ['Sample', 'Resin', 'AAdays', 'Color', 'PyTemp', 'OR', 'IS', 'RA', 'SN', 'dRI']
-  for item in items:
-    val = sp.pop(item, False)
+def formatspectrum(fn, name, sp):
+  # format the spectrum as a NIST MSP record; sp is not modified
+  # don't mind to much about the order of the lines; we start with Name, and end with NumPeaks and the spectral data
+  
+  # build comments
+  comments = []
+  for item in commentitems:
+    val = sp.get(item, False)
     if isinstance(val, list):
       val=";".join(val)
     if val:
-      comments += "{}={} ".format(item, val.replace(" ", "_"))
+      comments.append("{}={}".format(item, val.replace(" ", "_")))
   if "RI" in sp:
-    comments += "RI={} ".format(sp['RI'])
+    comments.append("RI={}".format(sp['RI']))
   if "RT" in sp:
-    comments += "RT={}".format(sp['RT'])
+    comments.append("RT={}".format(sp['RT']))
 
-  # remove other fields
-  numpeaks = sp.pop('Num Peaks')
-  xydata   = sp.pop('xydata')
-  compospectra = sp.pop('Spectra', None)
-  composamples = sp.pop('Samples', None)
-  
-  #verbose
-  if verbose:
-    print("    - Write", name, "in output file")
-  
-  #start with the Name field (and remove it from the dictionary)
+  #start with the Name field
   if len(name) > 78:
     name = name[:77]
     print("      WARNING: name cropped to ", name)
-  fh.write('Name: '   + name + "\n")
+  lines = ['Name: ' + name]
   
   # make sure we 'll have a CAS number 
   if 'CAS#' not in sp:
     casno = os.path.basename(fn)
     casno = os.path.splitext(casno)[0]
-    casno += "-" + name.split(" ", 1)[0]
-    fh.write('CAS#: ' + casno + "\n")
+    lines.append('CAS#: ' + casno + "-" + name.split(" ", 1)[0])
   
-  #then iterate over the remaining items
+  #then the remaining items (except lists, eg. multiple sources)
   for key, value in sp.items():
-    # if we still have lists (eg. multiple sources, remove them)
-    if isinstance(value, list): 
-      sp.pop(key)
-    else:
-      fh.write(key + ': ' + value + "\n")
+    if (key not in skipitems) and not isinstance(value, list): 
+      lines.append(key + ': ' + value)
     
   # make sure we'll have a source
   if 'SOURCE' not in sp:
-    fh.write('SOURCE: ' + fn + "\n")
-  
-  # write comments
-  fh.write('Comments: ' + comments.strip() + "\n")
+    lines.append('SOURCE: ' + fn)
   
-  # write NumPeaks
-  fh.write('Num Peaks: ' + str(numpeaks) + "\n")
+  lines.append('Comments: ' + " ".join(comments))
+  lines.append('Num Peaks: ' + str(sp['Num Peaks']))
   
   # NIST MSP puts 5 couples on each line
-  # 1. iterate over full lines
-  div = numpeaks // 5          # we have %div full lines
-  for i in range(div):         
-    line = ""  
-    for j in range(5): 
-      x, y = xydata.popitem(last = False)
-      line = line + str(x) + " " + str(y) + "; "
-    fh.write(line.rstrip(" ") + "\n")
-  # 2. iterate over the last incomplete line
-  mod = numpeaks % 5           # the last line will have mod couples
-  if mod > 0:
-    line = ""
-    for i in range(mod):
-      x, y = xydata.popitem(last = False)
-      line = line + str(x) + " " + str(y) + "; "
-    fh.write(line.rstrip(" ") + "\n")
-  fh.write("\n")
+  couples = ["{} {};".format(x, y) for x, y in sp['xydata'].items()]
+  for i in range(0, len(couples), 5):
+    lines.append(" ".join(couples[i:i+5]))
+  
+  lines.append("\n")
+  return "\n".join(lines)
+
+
+
+def writenpy(fn, descr, shape, blocks):
+  # write an array in NumPy .npy format (version 1.0), without depending on NumPy
+  # descr is the NumPy type string (eg. '<f8'), blocks an iterable of the raw (little-endian) bytes
+  header = "{{'descr': '{}', 'fortran_order': False, 'shape': ({}), }}".format(descr, "".join(str(n) + ", " for n in shape).rstrip(" "))
+  header += " " * (63 - (len(header) + 10) % 64) + "\n"   # the data is aligned on 64 bytes
+  with open(fn, "wb") as fh:
+    fh.write(b"\x93NUMPY\x01\x00" + struct.pack("<H", len(header)) + header.encode("latin-1"))
+    for block in blocks:
+      fh.write(block)
+
+
+
+def npynumbers(typecode, values):
+  # raw little-endian bytes of a numeric column
+  a = array(typecode, values)
+  if sys.byteorder == "big":
+    a.byteswap()
+  return a.tobytes()
+
+
+
+def npystrings(values):
+  # NumPy unicode type string and raw bytes of a string column
+  n = max([len(v) for v in values], default=0) or 1
+  return "<U" + str(n), b"".join(v.encode("utf-32-le").ljust(4 * n, b"\0") for v in values)
+
+
+
+def writecolumnar(outdir, data, mode, category="Source", verbose=False):
+  # write the spectra (and components) as columns of .npy files in outdir; returns the column descriptions
+  os.makedirs(outdir, exist_ok=True)
+  columns = OrderedDict()
+  
+  def column(name, descr, shape, blocks, about):
+    fn = name + ".npy"
+    writenpy(os.path.join(outdir, fn), descr, shape, blocks)
+    columns[name] = OrderedDict([('file', fn), ('dtype', descr), ('shape', list(shape)), ('description', about)])
+    if verbose: print("    - Wrote", fn, shape)
+  
+  def number(sp, field, convert=float, default=nan):
+    try:               return convert(sp[field])
+    except (KeyError, ValueError): return default
+  
+  ### spectrum metadata columns
+  
+  spectra = data['spectra']
+  names = list(spectra.keys())
+  n = len(names)
+  descr, raw = npystrings(names)
+  column("spectra_name", descr, (n,), [raw], "spectrum names (keys in the JSON data file)")
+  column("spectra_db", "<i8", (n,), [npynumbers('q', (number(sp, 'DB#', int, -1) for sp in spectra.values()))], "spectrum numbers (DB#)")
+  for field in ['RI', 'RT', 'IS', 'SN', 'RA', 'OR']:
+    column("spectra_" + field.lower(), "<f8", (n,), [npynumbers('d', (number(sp, field) for sp in spectra.values()))], field + " (NaN if unknown)")
+  for field in ['Source', 'Sample', 'Resin', 'AAdays', 'Color', 'PyTemp']:
+    values = [sp.get(field, "") for sp in spectra.values()]
+    descr, raw = npystrings(values)
+    column("spectra_" + field.lower(), descr, (n,), [raw], field + " (empty if unknown)")
+  
+  ### m/z intensity matrix: spectra in spectra mode, components in components mode
+  
+  splist = data['components'] if mode == "components" else spectra
+  masses = sorted(set(int(x) for sp in splist.values() for x in sp['xydata']))
+  position = {x: k for k, x in enumerate(masses)}
+  column("mz", "<i4", (len(masses),), [npynumbers('i', masses)], "m/z values (columns of the intensity matrix)")
+  
+  def rows():
+    for sp in splist.values():
+      row = array('i', bytes(4 * len(masses)))
+      for x, y in sp['xydata'].items():
+        row[position[int(x)]] = int(y)
+      if sys.byteorder == "big":
+        row.byteswap()
+      yield row.tobytes()
+  
+  prefix = "components" if mode == "components" else "spectra"
+  column(prefix + "_intensity", "<i4", (len(splist), len(masses)), rows(), prefix + " x m/z intensities (0 if absent)")
+  
+  ### component columns and abundance matrix
+  
+  if mode == "components":
+    components = data['components']
+    cnames = list(components.keys())
+    m = len(cnames)
+    descr, raw = npystrings(cnames)
+    column("components_name", descr, (m,), [raw], "component names")
+    column("components_db", "<i8", (m,), [npynumbers('q', (number(sp, 'DB#', int, -1) for sp in components.values()))], "component numbers (DB#)")
+    column("components_ri", "<f8", (m,), [npynumbers('d', (number(sp, 'RI') for sp in components.values()))], "component RI")
+    column("components_dri", "<f8", (m,), [npynumbers('d', (number(sp, 'dRI') for sp in components.values()))], "RI difference within the component")
+    column("components_count", "<i8", (m,), [npynumbers('q', (len(sp['Spectra']) for sp in components.values()))], "number of spectra of the component")
+    
+    # membership: component (row index) of each spectrum, -1 if none
+    spindex = {s: k for k, s in enumerate(names)}
+    membership = array('q', [-1] * n)
+    for k, sp in enumerate(components.values()):
+      for s in sp['Spectra']:
+        membership[spindex[s]] = k
+    column("spectra_component", "<i8", (n,), [npynumbers('q', membership)], "component (row in the component arrays) of each spectrum, -1 if none")
+    
+    # mean IS per component and category (IS defaults to 1, as in report.py)
+    catcodes = OrderedDict()
+    spcat = [catcodes.setdefault(sp.get(category, 'unknown'), len(catcodes)) for sp in spectra.values()]
+    spis = [number(sp, 'IS', int, 1) for sp in spectra.values()]
+    cats = sorted(catcodes)
+    position = {cat: k for k, cat in enumerate(cats)}
+    order = [position[cat] for cat in catcodes]    # category code -> column
+    
+    def abundance():
+      for sp in components.values():
+        sums = [0] * len(cats)
+        counts = [0] * len(cats)
+        for s in sp['Spectra']:
+          k = spindex[s]
+          sums[order[spcat[k]]] += spis[k]
+          counts[order[spcat[k]]] += 1
+        yield npynumbers('d', ((a / b) if b > 0 else nan for a, b in zip(sums, counts)))
+    
+    descr, raw = npystrings(cats)
+    column("categories", descr, (len(cats),), [raw], category + " categories (columns of the abundance matrix)")
+    column("components_abundance", "<f8", (m, len(cats)), abundance(), "component x category mean IS (NaN if absent)")
+  
+  with open(os.path.join(outdir, "columns.json"), "w") as fh:
+    fh.write(json.dumps(columns, indent=2))
+  
+  return columns
+
+
+
+def shardfile(mspfile, n):
+  # file name of shard n
+  base, ext = os.path.splitext(mspfile)
+  return "{}-{:03d}{}".format(base, n, ext if ext else ".msp")
+
+
+
+def writeshard(task):
+  # format and write one shard (mspfile, shard file, list of (name, spectrum)); used by the worker processes
+  # the records refer to mspfile (CAS#, SOURCE), so they don't depend on the sharding
+  fn, shard, items = task
+  with open(shard, "w") as fh:
+    for c in range(0, len(items), chunksize):
+      fh.write("".join(formatspectrum(fn, name, sp) for name, sp in items[c:c+chunksize]))
+  return len(items)
+
+
+
+def writeshards(mspfile, splist, n, by, jobs=1, verbose=False, progress=False):
+  # split the spectra into n contiguous shards with (nearly) equal numbers of spectra, in export 
+  # order or in RI order (spectra without RI last), and write them; returns the manifest rows
+  items = list(splist.items())
+  if by == "ri":
+    items.sort(key=lambda item: float(item[1]['RI']) if 'RI' in item[1] else inf)
+  n = max(1, min(n, len(items)))
+  shards = [items[len(items) * k // n : len(items) * (k + 1) // n] for k in range(n)]
+  tasks = [(mspfile, shardfile(mspfile, k + 1), shard) for k, shard in enumerate(shards)]
+  
+  # init progress bar
+  if progress and not verbose: 
+    j = 0
+    gcmstoolbox.printProgress(j, n)
+  
+  # each shard is written by a worker process
+  if jobs > 1:
+    pool = multiprocessing.Pool(jobs)
+    results = pool.imap(writeshard, tasks)
+  else:
+    pool = None
+    results = (writeshard(task) for task in tasks)
+  
+  manifest = []
+  try:
+    for k, (task, count) in enumerate(zip(tasks, results)):
+      for name, sp in task[2]:
+        manifest.append([k + 1, os.path.basename(task[1]), name, sp.get('DB#', ''), sp.get('RI', '')])
+    
+      # adjust progress bar
+      if verbose:
+        print("    - Wrote", count, "spectra in", task[1])
+      elif progress:
+        j += 1
+        gcmstoolbox.printProgress(j, n)
+  
+  finally:
+    if pool is not None:
+      pool.close()
+      pool.join()
+  
+  return manifest
+
+
+
+def writesizeshards(mspfile, splist, maxsize, jobs=1, verbose=False, progress=False):
+  # write the spectra in export order, starting a new shard whenever the next record would
+  # make the current shard larger than maxsize bytes; returns the manifest rows
+  items = list(splist.items())
+  chunks = [[(mspfile, name, sp) for name, sp in items[c:c+chunksize]] for c in range(0, len(items), chunksize)]
+  
+  # init progress bar
+  if progress and not verbose: 
+    j = 0
+    k = len(items)
+    gcmstoolbox.printProgress(j, k)
+  
+  # the records are formatted by the worker processes, and written in order
+  if jobs > 1:
+    pool = multiprocessing.Pool(jobs)
+    results = pool.imap(formatrecords, chunks)
+  else:
+    pool = None
+    results = (formatrecords(chunk) for chunk in chunks)
+  
+  manifest = []
+  n = 0
+  fh = None
+  encoding = locale.getpreferredencoding(False)   # the default encoding of open(), as all MSP files
+  try:
+    for chunk, records in zip(chunks, results):
+      for (fn, name, sp), record in zip(chunk, records):
+        # size of the record in the file (text mode writes \r\n on Windows)
+        recordsize = len(record.encode(encoding)) + (record.count("\n") if os.linesep == "\r\n" else 0)
+        if (fh is None) or ((size > 0) and (size + recordsize > maxsize)):
+          if fh is not None:
+            fh.close()
+          n += 1
+          fh = open(shardfile(mspfile, n), "w")
+          size = 0
+          if verbose: print("    - Writing", shardfile(mspfile, n))
+        fh.write(record)
+        size += recordsize
+        manifest.append([n, os.path.basename(shardfile(mspfile, n)), name, sp.get('DB#', ''), sp.get('RI', '')])
+    
+      # adjust progress bar
+      if progress and not verbose:
+        j += len(chunk)
+        gcmstoolbox.printProgress(j, k)
+  
+  finally:
+    if fh is not None:
+      fh.close()
+    if pool is not None:
+      pool.close()
+      pool.join()
+  
+  return manifest
+
+
+
+def formatrecords(chunk):
+  # format a list of (fn, name, spectrum) tuples as a list of records (used by the worker processes)
+  return [formatspectrum(fn, name, sp) for fn, name, sp in chunk]
+
+
+
+def formatchunk(chunk):
+  # format a list of (fn, name, spectrum) tuples as one block of text (used by the worker processes)
+  return "".join(formatspectrum(fn, name, sp) for fn, name, sp in chunk)
 
 
 
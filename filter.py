@@ -44,6 +44,7 @@ def main():
   group = OptionGroup(parser, "MAKE: Filter out groups on the number of spectra in a group")
   group.add_option("-c", "--count",      help="Minimal number of spectra per group", action="store", dest="count", type="int")
   group.add_option("-C",                 help="Don't count multiple spectra from the same source", action="store_true", dest="sourcecount", default=False)
+  group.add_option("-S",                 help="Don't count multiple spectra from the same sample", action="store_true", dest="samplecount", default=False)
   parser.add_option_group(group)
   
   group = OptionGroup(parser, "MAKE: Filter out groups based on the presence of a chosen m/z")
@@ -52,20 +53,23 @@ def main():
   group.add_option("-s", "--sum",        help="Calculate sumspectra with the N spectra with highest signal, 0 for all [default: 0]", action="store",  dest="n", type="int", default=0)
   parser.add_option_group(group)
   
+  gcmstoolbox.profileOptions(parser)
+  
   (options, args) = parser.parse_args()
   
   
   ### ARGUMENTS AND OPTIONS
   
   cmd = " ".join(sys.argv)
+  gcmstoolbox.startProfile(options, cmd)
 
   if options.verbose: print("Processing arguments...")
   
   # check and read JSON input file
-  data = gcmstoolbox.openJSON(options.jsonin)
+  data = gcmstoolbox.openJSON(options.jsonin, options.jsonout)
   if data['info']['mode'] == 'spectra':
     print("\n!! Cannot filter on ungrouped spectra.")
-    exit()
+    exit(1)
   
   # json output 
   if options.jsonout == None: 
@@ -78,11 +82,11 @@ def main():
   # command and arguments
   if len(args) == 0:
     print(" !! No command given\n")
-    exit()
+    exit(1)
   elif args[0].lower().startswith("l"):
     if len(args) > 1:
       print(" !! The list command does not support arguments\n")
-      exit()
+      exit(1)
     else: #LIST
       for id, it in data['filters'].items():
         print(id + ": filters out " + str(len(it['out'])) + " groups [" + ("Enabled" if it['active'] else "Disabled") + "]")
@@ -92,39 +96,82 @@ def main():
         print('')
       exit()
   elif (args[0].lower() == 'on') or (args[0].lower() == 'off'):
-    flist = [x.upper() for x in args]
-    act = True if (flist.pop(0) == 'ON') else False
-    safe = False
-    for f in flist:
-      if not f.startswith("F"): f = "F" + f
-      if f in data['filters']:
-        data['filters'][f]['active'] = act
-        print(('Enabled ' if act else 'Disabled ') + f)
-        safe = True
-    if safe:
+    act = (args[0].lower() == 'on')
+    changed = setfilters(data, args[1:], act)
+    for f in changed:
+      print(('Enabled ' if act else 'Disabled ') + f)
+    if len(changed) > 0:
       data["info"]["cmds"].append(cmd)
       gcmstoolbox.saveJSON(data, options.jsonout)     # backup and safe json
       print(" => Updated " + options.jsonout + "\n")
+      gcmstoolbox.stopProfile()
     else:
       print(" !! Invalid filter names\n")
+      exit(1)
     exit()
   elif args[0].lower().startswith("m"):
     if len(args) > 1:
       print(" !! The list command does not support arguments\n")
-      exit()
+      exit(1)
     # else: proceed
   else:
     print(" !! Invalid command given\n")
-    exit()
+    exit(1)
+    
+  
+  ### MAKE FILTER
+
+  try:
+    with gcmstoolbox.stage("filter", len(data['groups']), "groups"):
+      f = makefilter(data, options.group, options.count, options.sourcecount, options.samplecount, 
+                     options.mass, options.percent, options.n, verbose=options.verbose, progress=True)
+  except gcmstoolbox.GCMSError as e:
+    print("\n!! " + str(e) + "\n")
+    exit(1)
+
+  removed = data['filters'][f]['out']
+  print("\nFilter " + f)
+  print("  - initial number of groups:  " + str( len(data['groups']) ))
+  print("  - number of removed groups:  " + str( len(removed) ))
+  print("  - number of retained groups: " + str( len(data['groups']) - len(removed) ))
+
+  af, ac = activefilters(data)
+  
+  print("\nAll active filters (" + ", ".join(af) + ")")
+  print("  - initial number of groups:  " + str( len(data['groups']) ))
+  print("  - number of removed groups:  " + str( len(ac) ))
+  print("  - number of retained groups: " + str( len(data['groups']) - len(ac) ))
+
+  data["info"]["cmds"].append(cmd)
+  gcmstoolbox.saveJSON(data, options.jsonout)     # backup and safe json
+  
+  print(" => Finalised. Wrote " + options.jsonout + "\n")
+  gcmstoolbox.stopProfile()
+  exit()
+
+  
+    
+    
+def makefilter(data, group=None, count=None, sourcecount=False, samplecount=False, mass=None, percent=90, n=0, verbose=False, progress=False):
+  # define a new filter in data with the groups that meet the given criteria; returns its name (F1, F2...)
+  #   group: group numbers to be removed
+  #   count: minimal number of spectra (or sources, or samples) per group
+  #   mass:  m/z values that may not exceed percent % in the sumspectrum of the n spectra with the highest signal
+  # (progress: show the progress on the terminal)
+  if data['info']['mode'] == 'spectra':
+    raise gcmstoolbox.GCMSError("Cannot filter on ungrouped spectra.")
+  if sourcecount and samplecount:
+    raise gcmstoolbox.GCMSError("The options -C and -S cannot be used together")
     
   #criterium flags
-  c1 = False if options.group is None else True  #CRITERIUM1: group numbers to be removed
-  c2 = False if options.count is None else True  #CRITERIUM2: minimal spectrum count per group 
-  c3 = False if options.mass  is None else True  #CRITERIUM3: minimal intensity of choses m/z values
+  c1 = False if group is None else True  #CRITERIUM1: group numbers to be removed
+  c2 = False if count is None else True  #CRITERIUM2: minimal spectrum count per group 
+  c3 = False if mass  is None else True  #CRITERIUM3: minimal intensity of choses m/z values
 
   if not (c1 or c2 or c3):
-    print("\n!! No criteria selected. Nothing to do.")
-    exit()
+    raise gcmstoolbox.GCMSError("No criteria selected. Nothing to do.")
+
+  bar = progress and not verbose   # progress bars
 
     
   ### INITIALISE
@@ -138,13 +185,13 @@ def main():
   ### CRITERIUM 1: GROUP NUMBER
   if c1:
     removegroups = []
-    for g in options.group:
+    for g in group:
       g = str(g).upper()
       if not g.startswith('G'): g = "G" + g
       removegroups.append(g)
     
-    print("\nCRITERIUM 1: remove groups by group numbers: " + ", ".join(removegroups))
-    if not options.verbose: 
+    if progress or verbose: print("\nCRITERIUM 1: remove groups by group numbers: " + ", ".join(removegroups))
+    if bar: 
       i = 0
       j = len(candidates)
       gcmstoolbox.printProgress(i, j)
@@ -154,11 +201,11 @@ def main():
         candidates.discard(c)
         
       # progress bar
-      if not options.verbose: 
+      if bar: 
         i += 1
         gcmstoolbox.printProgress(i, j)
   
-    if options.verbose: 
+    if verbose: 
       print("candidates for removal:")
       if len(candidates) == 0:
         print("  none")
@@ -168,35 +215,32 @@ def main():
   
   ### CRITERIUM 2: SPECTRUM COUNT
   if c2:
-    print("\nCRITERIUM 2: remove groups with less than " + str(options.count) + " spectra...")
-    if not options.verbose: 
+    if progress or verbose: print("\nCRITERIUM 2: remove groups with less than " + str(count) + " spectra...")
+    if bar: 
       i = 0
       j = len(candidates)
       gcmstoolbox.printProgress(i, j)
       
     for c in list(candidates):   # iterate over a copy of the set, so we can remove things from the original while iterating
-      if not options.sourcecount:
-        # count number of spectra
-        if data["groups"][c]["count"] >= options.count:  #remove from candidates = keep group
-          candidates.discard(c)
+      g = data["groups"][c]
+      if sourcecount:
+        # count number of sources (precomputed by group.py; recount for older data files)
+        number = g["sources"] if "sources" in g else countdistinct(data["spectra"], g, "Source")
+      elif samplecount:
+        # count number of samples
+        number = g["samples"] if "samples" in g else countdistinct(data["spectra"], g, "Sample")
       else:
-        # count number of sources
-        spset = set()
-        nosource = 0   # also count spectra without source
-        for s in data["groups"][c]["spectra"]:
-          if "Source" in data["spectra"][s]:
-            spset.add(data["spectra"][s]["Source"])
-          else:
-            nosource += 1
-        if (len(spset) + nosource) >= options.count:  #remove from candidates = keep group
-          candidates.discard(c)
+        # count number of spectra
+        number = g["count"]
+      if number >= count:  #remove from candidates = keep group
+        candidates.discard(c)
         
       # progress bar
-      if not options.verbose: 
+      if bar: 
         i += 1
         gcmstoolbox.printProgress(i, j)
   
-    if options.verbose: 
+    if verbose: 
       print("candidates for removal:")
       if len(candidates) == 0:
         print("  none")
@@ -206,8 +250,8 @@ def main():
 
   ### CRITERIUM 3: RUBBISH PEAK SEARCH
   if c3:
-    print("\nCRITERIUM 3: remove groups with m/z value " + ", ".join(str(m) for m in options.mass))
-    if not options.verbose: 
+    if progress or verbose: print("\nCRITERIUM 3: remove groups with m/z value " + ", ".join(str(m) for m in mass))
+    if bar: 
       i = 0
       j = len(candidates)
       gcmstoolbox.printProgress(i, j)
@@ -220,18 +264,20 @@ def main():
       
       # if more than one spectrum, make sumspectrum
       if len(splist) > 1:
-        sumsp = gcmstoolbox.sumspectrum(*splist, highest = options.n)
+        sumsp = gcmstoolbox.sumspectrum(*splist, highest = n)
       else:
         sumsp = splist[0]
         
       # check masses
       remove = False     
-      maxval = max(sumsp['xydata'].values())
-      for m in options.mass:
-        if str(m) in sumsp['xydata']:
-          if int(sumsp['xydata'][str(m)]) > (maxval * 0.01 * options.percent):     #remove group
-            if options.verbose:
-              print(" --> G" + c + " m/z=" + str(m) + " y-value=" + str(sumsp['xydata'][str(m)]) + " threshold=" + str(maxval * 0.01 * options.percent))
+      # (the m/z values are strings in a data file, and numbers after import or build)
+      xydata = {int(x): y for x, y in sumsp['xydata'].items()}
+      maxval = max(xydata.values())
+      for m in mass:
+        if m in xydata:
+          if int(xydata[m]) > (maxval * 0.01 * percent):     #remove group
+            if verbose:
+              print(" --> G" + c + " m/z=" + str(m) + " y-value=" + str(xydata[m]) + " threshold=" + str(maxval * 0.01 * percent))
             remove = True
 
       # final decission
@@ -240,11 +286,11 @@ def main():
         candidates.discard(c)
         
       # progress bar
-      if not options.verbose: 
+      if bar: 
         i += 1
         gcmstoolbox.printProgress(i, j)
       
-    if options.verbose: 
+    if verbose: 
       print("candidates for removal:")
       if len(candidates) == 0:
         print("  none")
@@ -252,7 +298,7 @@ def main():
         print(tabulate(candidates))
     
         
-  ### UPDATE GROUPS AND WRITE IT AS JSON
+  ### UPDATE GROUPS
   
   if 'filters' not in data:
     data['filters'] = OrderedDict()
@@ -262,37 +308,54 @@ def main():
     
   data['filters'][f] = OrderedDict()
   if c1: data['filters'][f]['crit1'] = ", ".join(removegroups)
-  if c2: data['filters'][f]['crit2'] = str(options.count)
-  if c3: data['filters'][f]['crit3'] = "m/z " + ", ".join(str(m) for m in options.mass) + "; " + str(options.percent) + "%; " + str(options.n)
+  if c2: data['filters'][f]['crit2'] = str(count) + (" sources" if sourcecount else (" samples" if samplecount else ""))
+  if c3: data['filters'][f]['crit3'] = "m/z " + ", ".join(str(m) for m in mass) + "; " + str(percent) + "%; " + str(n)
   data['filters'][f]['active'] = True
   data['filters'][f]['out'] = sorted(candidates)
 
-  print("\nFilter " + f)
-  print("  - initial number of groups:  " + str( len(data['groups']) ))
-  print("  - number of removed groups:  " + str( len(candidates) ))
-  print("  - number of retained groups: " + str( len(data['groups']) - len(candidates) ))
+  data['info']['mode'] = "filter"
+  return f
+
 
+
+def setfilters(data, filters, active):
+  # enable (active=True) or disable filters, given by name (F1) or number; returns the changed filters
+  changed = []
+  for f in filters:
+    f = str(f).upper()
+    if not f.startswith("F"): f = "F" + f
+    if f in data.get('filters', {}):
+      data['filters'][f]['active'] = active
+      changed.append(f)
+  return changed
+
+
+
+def activefilters(data):
+  # names of the active filters, and the set of groups that they remove
   af = []
   ac = set()
-  for f, filter in data['filters'].items():
+  for f, filter in data.get('filters', {}).items():
     if filter['active']:
       af.append(f)
       ac.update(filter['out'])
-  
-  print("\nAll active filters (" + ", ".join(af) + ")")
-  print("  - initial number of groups:  " + str( len(data['groups']) ))
-  print("  - number of removed groups:  " + str( len(ac) ))
-  print("  - number of retained groups: " + str( len(data['groups']) - len(ac) ))
+  return af, ac
+
+
+
+def countdistinct(spectra, group, item):
+  # number of distinct values of item in a group; spectra without this item are counted separately
+  values = set()
+  missing = 0
+  for s in group["spectra"]:
+    if item in spectra[s]:
+      values.add(spectra[s][item])
+    else:
+      missing += 1
+  return len(values) + missing
+
 
-  data['info']['mode'] = "filter"
-  data["info"]["cmds"].append(cmd)
-  gcmstoolbox.saveJSON(data, options.jsonout)     # backup and safe json
-  
-  print(" => Finalised. Wrote " + options.jsonout + "\n")
-  exit()
 
-  
-    
     
 def tabulate(words, termwidth=79, pad=3):
   words = sorted(int(x) for x in words)
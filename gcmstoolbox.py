@@ -5,7 +5,14 @@ import sys
 import os
 import pprint
 import json
+import pickle
 import time
+import hashlib
+import cProfile
+import pstats
+import tracemalloc
+from contextlib import contextmanager
+from optparse import OptionGroup
 from collections import OrderedDict
 
 
@@ -20,6 +27,12 @@ version = "4.2   "       #6 chars!
 date    = "11 Jul 2020"  #11 chars!
 
 
+# errors of the GCMStoolbox functions (eg. group.groupspectra, build.buildcomponents...), which can
+# be used as a library; the command line tools print the message and exit
+class GCMSError(Exception):
+  pass
+
+
 # ELinC resin names
 resin = { "BLANCO":  "B",
           "BLK0001": "TR",
@@ -177,9 +190,147 @@ def sumspectrum(*spectra, signal="IS", highest=False):
 
 
 
+
+
+def consensusspectrum(*spectra, signal="IS", highest=False, mode="median", trim=0.1, presence=0):
+  # robust alternative for sumspectrum: the spectra are combined per m/z as
+  #   mode="sum":     signal-weighted sum (as sumspectrum)
+  #   mode="median":  signal-weighted median
+  #   mode="trimmed": mean after removing a fraction trim of the lowest and of the highest values
+  # missing m/z values count as 0; m/z values found in less than a fraction presence
+  # of the spectra are removed
+  
+  ### calculate signals (as in sumspectrum)
+  
+  signals = []
+  for sp in spectra:
+    if signal in sp: signals.append(float(sp[signal]))
+    else           : signals.append(0)
+  
+  maxsignal = max(signals)
+  minsignal = min([s for s in signals if s != 0], default=0)
+  if maxsignal != 0:
+    signals = [((minsignal*0.1) if s==0 else s) for s in signals]
+  else:
+    signals = [1 for s in signals]
+  
+  ### reduce to the highest signals
+  
+  order = sorted(range(len(spectra)), key=lambda k: signals[k], reverse=True)
+  if highest:
+    order = order[:highest]
+  spectra = [spectra[k] for k in order]
+  signals = [signals[k] for k in order]
+  n = len(spectra)
+  
+  ### intensity columns: for each m/z the intensities in all spectra (0 if absent)
+  
+  columns = {}
+  for k, sp in enumerate(spectra):
+    for x, y in sp['xydata'].items():
+      if x not in columns:
+        columns[x] = [0] * n
+      columns[x][k] = y
+  
+  ### combine the columns
+  
+  xy = {}
+  totalsignal = sum(signals)
+  cut = int(trim * n)
+  for x, column in columns.items():
+    if (presence > 0) and (sum(1 for y in column if y != 0) < presence * n):
+      continue
+    if mode == "sum":
+      value = sum(si * y for si, y in zip(signals, column))
+    elif mode == "median":
+      # weighted median: the value at which the cumulative signal reaches half of the total
+      cumulative = 0
+      for y, si in sorted(zip(column, signals)):
+        cumulative += si
+        if cumulative >= totalsignal / 2:
+          value = y
+          break
+    elif mode == "trimmed":
+      column = sorted(column)[cut:n-cut]
+      value = sum(column) / len(column)
+    if value > 0:
+      xy[x] = value
+  
+  # if nothing is left (e.g. no m/z value in the majority of the spectra), fall back to the sum
+  if len(xy) == 0:
+    return sumspectrum(*spectra, signal=signal)
+  
+  xysum = OrderedDict()
+  for x in sorted(xy, key=int):
+    xysum[x] = xy[x]
+  normalise(xysum)
+  
+  # means and medians are not necessarily integers (normalise only rounds when it rescales)
+  for x in list(xysum.keys()):
+    xysum[x] = int(round(xysum[x]))
+    if xysum[x] == 0:
+      del xysum[x]
+  
+  ### RI and output (as in sumspectrum)
+  
+  rilist = [float(sp['RI']) for sp in spectra if 'RI' in sp]
+  
+  sp = OrderedDict()
+  if len(rilist) > 0:
+    sp['RI'] = str(round(sum(rilist) / float(len(rilist)),1))
+    sp['dRI'] = str(round(max(rilist) - min(rilist),1))
+  sp['Num Peaks'] = len(xysum)
+  sp['xydata'] = xysum
+  
+  return sp
+
+
+
+def grouphash(names):
+  # fingerprint of the membership of a group (the names of its spectra)
+  return hashlib.md5("\n".join(names).encode("utf-8")).hexdigest()
+
+
+
+def sumsignalsHeader(mkreport):
+  # header rows of a sumsignals CSV report (sumsignals.py, import.py --sumsignals); mkreport is a csv.writer
+  mkreport.writerow(["Intgr.signal (IS)", "The area under the actual extracted component shape expressed in the units of the instrument it was acquired on"])
+  mkreport.writerow(["Area (XN)",         "This area is expressed in the units of the instrument that the component was acquired on and is computed by starting from the extracted component shape, but then using any baseline extension that seems reasonable to one or both sides of the actual extracted peak (Extra Width)"])
+  mkreport.writerow(["Base peak (AM)",    "The abundance of the most intense mass spectral peak in the deconvoluted spectrum"])
+  mkreport.writerow(["Amount (RA)",       "The area of the deconvoluted component (Area) relative to the total ion count for the entire chromatogram, expressed as a percentage"])
+  mkreport.writerow("")
+  mkreport.writerow(["ELU file", "spectra count", "sum of Integr.signals", "sum of Areas", "sum of Base peaks", "sum of Amounts"])
+
+
+
+def sumsignalsRow(source, count, totIS, totXN, totAM, totRA):
+  # report row of a sumsignals CSV report
+  return [source, count, totIS, totXN, totAM, "{0:.6f}".format(totRA)]
+
  
  
 
+# progress bar: redrawn at most every progressinterval seconds; progressbar None draws it only
+# if stdout is a terminal (otherwise only the completed bar is printed), True or False always or never
+progressbar = None
+progressinterval = 0.1
+
+# progress hooks: functions that are called with a progress event (dict with stage, done, total,
+# rate (items/s), eta and elapsed (s)) at the start and the end of a loop, and at each redraw
+progresshooks = []
+
+# the progress of the current loop: total, start and last redraw time, and the stage
+progressstate = None
+
+def addProgressHook(hook):
+  # eg. gcmstoolbox.addProgressHook(lambda event: print(event['stage'], event['done'], event['eta']))
+  progresshooks.append(hook)
+
+def removeProgressHook(hook):
+  if hook in progresshooks:
+    progresshooks.remove(hook)
+
+
 # Print iterations progress
 def printProgress (iteration, total, prefix = '', suffix = '', decimals = 1, barLength = 50):
     """
@@ -192,34 +343,297 @@ def printProgress (iteration, total, prefix = '', suffix = '', decimals = 1, bar
         decimals    - Optional  : positive number of decimals in percent complete (Int)
         barLength   - Optional  : character length of bar (Int)
     """
+    global progressstate
+    now = time.perf_counter()
+    state = progressstate
+    if (state is None) or (iteration == 0) or (total != state['total']) or (iteration < state['done']):
+      # a new loop
+      state = progressstate = {'total': total, 'done': iteration, 'start': now, 'last': None,
+                               'stage': prefix.strip() or stagename}
+    state['done'] = iteration
+    
+    # throttle: only the first and the last iteration, and at most every progressinterval seconds
+    if (iteration != total) and (state['last'] is not None) and (now - state['last'] < progressinterval):
+      return
+    state['last'] = now
+    
+    if progresshooks:
+      elapsed = now - state['start']
+      rate = iteration / elapsed if elapsed > 0 else 0
+      event = {'stage': state['stage'], 'done': iteration, 'total': total, 'rate': rate,
+               'eta': ((total - iteration) / rate) if rate > 0 else None, 'elapsed': elapsed}
+      for hook in list(progresshooks):
+        hook(event)
+    
+    draw = progressbar if progressbar is not None else sys.stdout.isatty()
+    if not draw and ((progressbar is not None) or (iteration != total)):
+      return
+    
     formatStr = "{0:." + str(decimals) + "f}"
-    percent = formatStr.format(100 * (iteration / float(total)))
-    filledLength = int(round(barLength * iteration / float(total)))
+    percent = formatStr.format(100 * (iteration / float(total))) if total > 0 else formatStr.format(100)
+    filledLength = int(round(barLength * iteration / float(total))) if total > 0 else barLength
     bar = '█' * filledLength + '-' * (barLength - filledLength)
-    sys.stdout.write('\r%s |%s| %s%s %s' % (prefix, bar, percent, '%', suffix)),
+    sys.stdout.write(('\r' if draw else '') + '%s |%s| %s%s %s' % (prefix, bar, percent, '%', suffix)),
     if iteration == total:
         sys.stdout.write('\n')
     sys.stdout.flush()
 
 
-def openJSON(jsonin):
+# in-memory datasets of the pipeline runner (pipeline.py): when enabled, openJSON and saveJSON
+# keep the data files in memory ({path: [data, unsaved]}), and they are only written to disk
+# by flushJSON at the checkpoints of the pipeline
+datasets = None
+
+# the in-memory data files that a command opened or saved, if enabled by server.py (a dict): path
+# -> a snapshot (pickle) of the data if it had unsaved changes, else None; after a failed command,
+# its data may have been changed halfway, so server.py restores the snapshots and drops the others
+touched = None
+
+
+def keepJSON():
+  global datasets
+  if datasets is None: datasets = OrderedDict()
+
+
+
+def flushJSON():
+  # write the unsaved in-memory data files to disk; returns their file names
+  written = []
+  if datasets is not None:
+    for path, dataset in datasets.items():
+      if dataset[1]:
+        writeJSON(dataset[0], path)
+        dataset[1] = False
+        written.append(path)
+  return written
+
+
+
+def openJSON(jsonin, jsonout=None):
+  # jsonout: the file to which the command saves the data, if another file than jsonin; in memory,
+  # the command then gets a copy of a data file with unsaved changes, which stay with jsonin
+  if datasets is not None:
+    path = os.path.abspath(jsonin)
+    snapshotJSON(path)
+    if path in datasets:
+      data, unsaved = datasets[path]
+      if unsaved and (jsonout is not None) and (os.path.abspath(jsonout) != path):
+        return pickle.loads(pickle.dumps(data, pickle.HIGHEST_PROTOCOL))
+      return data
   if not os.path.isfile(jsonin):
     print("  !! " + jsonin + " was not found.\n")
-    exit()
-  with open(jsonin,'r') as fh:
-    data = json.load(fh, object_pairs_hook=OrderedDict)
+    exit(1)
+  with stage("load " + os.path.basename(jsonin), os.path.getsize(jsonin), "bytes"):
+    with open(jsonin,'r') as fh:
+      data = json.load(fh, object_pairs_hook=OrderedDict)
+    interncategories(data)
+  if datasets is not None:
+    datasets[os.path.abspath(jsonin)] = [data, False]
   return data
     
 
     
-def saveJSON(data, jsonout):
+def snapshotJSON(path):
+  # keep the state of an in-memory data file before a command first uses it (see touched)
+  if (touched is not None) and (path not in touched):
+    if (path in datasets) and datasets[path][1]:
+      touched[path] = pickle.dumps(datasets[path][0], pickle.HIGHEST_PROTOCOL)
+    else:
+      touched[path] = None
+
+
+
+def saveJSON(data, jsonout, backup=True):
+  # the profile of this command (see startProfile) is kept in the data file, with the stages so far
+  if profile is not None:
+    profile['summary']['wall'] = round(time.perf_counter() - profile['start'][0], 6)
+    profile['summary']['cpu'] = round(time.process_time() - profile['start'][1], 6)
+    if not any(p is profile['summary'] for p in data['info'].get('profiles', [])):
+      data['info'].setdefault('profiles', []).append(profile['summary'])
+  
+  if datasets is not None:
+    path = os.path.abspath(jsonout)
+    # the commands change their data in place: if it came from another file, that file is
+    # dropped from memory, and it will be read again from disk if needed (with unsaved changes,
+    # it is written first; the commands avoid this with a copy, see openJSON)
+    snapshotJSON(path)
+    for other in [k for k, v in datasets.items() if (v[0] is data) and (k != path)]:
+      if datasets[other][1]:
+        writeJSON(data, other)
+      del datasets[other]
+    datasets[path] = [data, True]
+  else:
+    writeJSON(data, jsonout, backup)
+
+
+
+def writeJSON(data, jsonout, backup=True):
   #backup
-  if os.path.isfile(jsonout):
+  if backup and os.path.isfile(jsonout):
     os.rename(jsonout, jsonout + time.strftime("%Y%m%d%H%M%S"))
   #safe new JSON file
-  with open(jsonout,'w') as fh:
-    fh.write(json.dumps(data, indent=2))
+  with stage("save " + os.path.basename(jsonout), unit="bytes") as record:
+    text = json.dumps(data, indent=2)
+    with open(jsonout,'w') as fh:
+      fh.write(text)
+    record['items'] = len(text)
+
+
+
+
+# metadata fields that repeat the same few values on many spectra: in memory, each value is kept
+# once (interned, so that comparing and hashing them in sets and dicts is cheap); the tools that
+# count or aggregate them work on integer codes (see categorycodes), the data file has the values
+categorical = ['Source', 'Sample', 'Resin', 'Color', 'PyTemp', 'AAdays']
+
+def categorycodes(spectra, fields=categorical):
+  # code the values of the given fields of the spectra (a dictionary or a list) as integers:
+  # returns the values of each field (field -> list of values, the code is the position in the list)
+  # and, for each spectrum in order, a tuple with the codes of the fields (-1 if the field is missing)
+  index = OrderedDict((field, {}) for field in fields)
+  codes = []
+  if isinstance(spectra, dict):
+    spectra = spectra.values()
+  for sp in spectra:
+    codes.append(tuple(index[field].setdefault(sp[field], len(index[field])) if field in sp else -1
+                       for field in fields))
+  tables = OrderedDict((field, list(values)) for field, values in index.items())
+  return tables, codes
+
+
+
+def interncategories(data):
+  # intern the values of the categorical fields of the spectra and components, so that each value
+  # is kept once in memory (the codes of categorycodes are made per command, not stored)
+  for sp in data.get('spectra', {}).values():
+    for field in categorical:
+      if isinstance(sp.get(field), str):
+        sp[field] = sys.intern(sp[field])
+  for sp in data.get('components', {}).values():
+    for field in categorical:
+      if isinstance(sp.get(field), list):
+        sp[field] = [sys.intern(value) for value in sp[field]]
+
+
+
+def logCommand(jsonfile, cmd):
+  # append a command to the command history of a JSON data file without rewriting it:
+  # read-only commands (export, report) are logged in a small history file next to it,
+  # complementing the commands in data['info']['cmds'] of the data file itself
+  with open(jsonfile + ".cmds", 'a') as fh:
+    fh.write(time.strftime("%Y-%m-%d %H:%M:%S") + "  " + cmd + "\n")
+
+
+
+
+# profile of the current command (--profile): the wall time, CPU time, number of items and throughput
+# of each stage (see stage), and optionally cProfile and tracemalloc statistics; None if not profiling
+profile = None
+
+
+def profileOptions(parser):
+  # add the profile options to the OptionParser of a command
+  group = OptionGroup(parser, "PROFILE", "Write a JSON report with the wall time, CPU time, number of items and throughput of each stage (load, parse, compute, save...). The stages are also kept in the JSON data file (info, profiles) if it is written.")
+  group.add_option("--profile",  help="JSON profile report file name", action="store", dest="profile", type="string")
+  group.add_option("--profiler", help="Add details to the profile report: cprofile|tracemalloc, comma separated", action="store", dest="profiler", type="string", default="")
+  parser.add_option_group(group)
+
+
+
+def startProfile(options, cmd):
+  # start profiling if the --profile option is given
+  global profile
+  if profile is not None:
+    # a command run by the pipeline: its stages are added to the profile of the pipeline
+    profile['nested'] += 1
+    return
+  if options.profile is None:
+    return
+  details = [x.strip().lower() for x in options.profiler.split(",") if x.strip() != ""]
+  for detail in details:
+    if detail not in ["cprofile", "tracemalloc"]:
+      print(" !! Unknown profiler: " + detail + " (possible profilers are 'cprofile' and 'tracemalloc')\n")
+      exit(1)
+  
+  summary = OrderedDict([('cmd', cmd), ('date', time.strftime("%Y-%m-%d %H:%M:%S")), ('wall', 0), ('cpu', 0), ('stages', [])])
+  profile = {'file': options.profile, 'summary': summary, 'start': (time.perf_counter(), time.process_time()), 'cprofile': None, 'tracemalloc': False, 'nested': 0}
+  if "tracemalloc" in details:
+    tracemalloc.start()
+    profile['tracemalloc'] = True
+  if "cprofile" in details:
+    profile['cprofile'] = cProfile.Profile()
+    profile['cprofile'].enable()
+
+
+
+# name of the current stage (also without profiling), used in the progress events
+stagename = ""
+
+@contextmanager
+def stage(name, items=None, unit="items"):
+  # time a stage of a command, eg. with stage("build", len(groups)): ...
+  # the number of items can also be set afterwards in the yielded record (record['items'])
+  global stagename
+  record = OrderedDict([('stage', name), ('wall', 0), ('cpu', 0), ('items', items), ('unit', unit)])
+  outer, stagename = stagename, name
+  if profile is None:
+    try:
+      yield record
+    finally:
+      stagename = outer
+    return
+  if profile['tracemalloc'] and hasattr(tracemalloc, "reset_peak"): 
+    tracemalloc.reset_peak()
+  wall, cpu = time.perf_counter(), time.process_time()
+  try:
+    yield record
+  finally:
+    stagename = outer
+    record['wall'] = round(time.perf_counter() - wall, 6)
+    record['cpu'] = round(time.process_time() - cpu, 6)
+    if (record['items'] is not None) and (record['wall'] > 0):
+      record['throughput'] = round(record['items'] / record['wall'], 3)
+    if profile['tracemalloc']:
+      record['peak memory'] = tracemalloc.get_traced_memory()[1]
+    profile['summary']['stages'].append(record)
+
+
+
+def stopProfile():
+  # write the profile report (if profiling)
+  global profile
+  if profile is None:
+    return
+  if profile['nested'] > 0:
+    profile['nested'] -= 1
+    return
+  summary = profile['summary']
+  summary['wall'] = round(time.perf_counter() - profile['start'][0], 6)
+  summary['cpu'] = round(time.process_time() - profile['start'][1], 6)
+  report = OrderedDict(summary)
+  
+  if profile['cprofile'] is not None:
+    # the 30 functions with the highest cumulative time
+    profile['cprofile'].disable()
+    stats = pstats.Stats(profile['cprofile'])
+    top = sorted(stats.stats.items(), key=lambda item: item[1][3], reverse=True)[:30]
+    report['cprofile'] = [OrderedDict([('function', "{}:{}({})".format(*f)), ('calls', v[1]), ('tottime', round(v[2], 6)), ('cumtime', round(v[3], 6))])
+                          for f, v in top]
+  
+  if profile['tracemalloc']:
+    # the 20 source lines that allocated most of the memory that is still in use
+    snapshot = tracemalloc.take_snapshot()
+    report['peak memory'] = tracemalloc.get_traced_memory()[1]
+    report['tracemalloc'] = [OrderedDict([('line', str(s.traceback)), ('size', s.size), ('count', s.count)])
+                             for s in snapshot.statistics('lineno')[:20]]
+    tracemalloc.stop()
+  
+  with open(profile['file'], 'w') as fh:
+    fh.write(json.dumps(report, indent=2))
+  print(" => Wrote profile report " + profile['file'])
+  profile = None
+
+
 
-    
 if __name__ == "__main__":
   main()
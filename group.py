@@ -8,12 +8,6 @@ from optparse import OptionParser, OptionGroup
 import gcmstoolbox
 
 
-#globals
-data = OrderedDict()
-allocations = OrderedDict()  #dictionary of all spectra with the groups to which they belong
-doubles = OrderedDict()  #dictionary of groups of possibly the same component
-
-
 def main():
   print("\n*******************************************************************************")
   print(  "* GCMStoolbox - a set of tools for GC-MS data analysis                        *")
@@ -51,32 +45,33 @@ def main():
   group.add_option("-M", "--merge",  help="Merge groups with ambiguous matches", action="store_true", dest="merge", default=False)
   parser.add_option_group(group)
   
+  gcmstoolbox.profileOptions(parser)
+  
   (options, args) = parser.parse_args()
 
   
   ### ARGUMENTS AND OPTIONS
-
-  global data, allocations, doubles, j, k
   
   cmd = " ".join(sys.argv)
+  gcmstoolbox.startProfile(options, cmd)
   
   if options.verbose: print("Processing arguments")
 
   # input file
   if len(args) == 0:
     print(" !! No MSPEPSEARCH file?\n")
-    exit()
+    exit(1)
   elif len(args) >= 2:
     print("  !! Too many arguments. Only one MSPEPSEARCH file can be processed.")
-    exit()
+    exit(1)
   elif os.path.isfile(args[0]):
     inFile = args[0]
   else:
     print("  !! MSPEPSEARCH file " + args[0] +  " not found.")
-    exit()
+    exit(1)
   
   # check and read JSON input file
-  data = gcmstoolbox.openJSON(options.jsonin)
+  data = gcmstoolbox.openJSON(options.jsonin, options.jsonout)
     
   # json output 
   if options.jsonout == None: 
@@ -88,11 +83,59 @@ def main():
     
 
   ### GROUP
- 
+
+  try:
+    with gcmstoolbox.stage("group", len(data['spectra']), "spectra"):
+      stats = groupspectra(data, inFile, options.rifixed, options.rifactor, options.discard, options.minmf, options.minrmf, 
+                           options.merge, verbose=options.verbose, progress=True)
+  except gcmstoolbox.GCMSError as e:
+    print("\n!! FATAL ERROR: " + str(e) + "\n")
+    exit(1)
+        
+
+  ### STATS
+  
+  print("\nSTATISTICS")
+  print("  - Number of mass spectra: " + str(stats["spectra"]))
+  print("  - Number of groups:       " + str(stats["groups"]))
+  if not options.merge:
+    print("  - Groups that may be the same component:")
+    for d in sorted(stats["ambiguous"]):
+      print("      - " + ", ".join(str(x) for x in d))
+  print("  - Number of hits per group:")
+  
+  if options.verbose:
+    lines = groupstats(data['groups'], options.verbose)
+  else:
+    lines = stats["stats"]
+  for l in lines:
+    print("      - " + l)
+  
+
+  ### UPDATE JSON FILE
+  
+  if options.verbose: print("\nUpdate JSON output file: " + options.jsonout + "\n")
+  data["info"]["cmds"].append(cmd)
+  gcmstoolbox.saveJSON(data, options.jsonout)     # backup and safe json
+  print("\nFinalised. Wrote " + options.jsonout + "\n")
+  
+  gcmstoolbox.stopProfile()
+  exit()
+
+
+
+
+def groupspectra(data, inFile, rifixed=0, rifactor=0, discard=False, minmf=0, minrmf=0, merge=False, verbose=False, progress=False):
+  # group the spectra in data with the hits of an MSPEPSEARCH file (a search of the spectra against
+  # themselves); sets data['groups'] and the grouping statistics in data['info'], which are returned
+  # (progress: show the progress on the terminal)
+  allocations = OrderedDict()  #dictionary of all spectra with the groups to which they belong
+  doubles = OrderedDict()      #dictionary of groups of possibly the same component
+
   # init progress bar
-  print("\nProcessing file: " + inFile)
+  if progress or verbose: print("\nProcessing file: " + inFile)
   k = len(data['spectra'])
-  if not options.verbose:
+  if progress and not verbose:
     j = 0
     gcmstoolbox.printProgress(j, k)
   
@@ -102,10 +145,10 @@ def main():
     for line in fh:
       for z in range(k):
         if line.casefold().startswith('unknown'):
-          line, i = readlist(fh, line, i, options.rifixed, options.rifactor, options.discard, options.minmf, options.minrmf, options.merge, options.verbose)
+          line, i = readlist(fh, line, i, data['spectra'], allocations, doubles, rifixed, rifactor, discard, minmf, minrmf, merge, verbose)
           
           # update progress bar 
-          if not options.verbose: 
+          if progress and not verbose: 
             j += 1
             gcmstoolbox.printProgress(j, k)
           
@@ -114,11 +157,11 @@ def main():
 
   ### BUILD GROUPS
   
-  print("\nGrouping spectra ...")
+  if progress or verbose: print("\nGrouping spectra ...")
   data['groups'] = OrderedDict()
 
   # init progress bar
-  if not options.verbose: 
+  if progress and not verbose: 
     j = 0
     k = len(data['spectra'])
     gcmstoolbox.printProgress(j, k)
@@ -126,14 +169,15 @@ def main():
 
   for s, g in allocations.items():
     g = "G" + str(g)
-    buildgroups(data['groups'], g, s)
+    buildgroups(data['spectra'], data['groups'], g, s)
     
     # adjust progress bar
-    if not options.verbose: 
+    if progress and not verbose: 
       j += 1
       gcmstoolbox.printProgress(j, k) 
-    
-  del allocations
+
+  # distinct sources and samples per group (used by the -C filter)
+  countsources(data['spectra'], data['groups'])
         
 
   ### STATS
@@ -141,44 +185,21 @@ def main():
   stats = OrderedDict()
   stats["spectra"] = len(data['spectra'])
   stats["groups"]  = len(data['groups'])
-  if options.merge: stats["merged"]    = [sorted(d) for d in doubles.values()]
-  else:             stats["ambiguous"] = [sorted(d) for d in doubles.values()]
+  if merge: stats["merged"]    = [sorted(d) for d in doubles.values()]
+  else:     stats["ambiguous"] = [sorted(d) for d in doubles.values()]
   stats["stats"] = groupstats(data['groups'])
-  
-  print("\nSTATISTICS")
-  print("  - Number of mass spectra: " + str(stats["spectra"]))
-  print("  - Number of groups:       " + str(stats["groups"]))
-  if not options.merge:
-    print("  - Groups that may be the same component:")
-    for key in sorted(doubles.keys()):
-      print("      - " + ", ".join(str(d) for d in sorted(doubles[key])))
-  print("  - Number of hits per group:")
-  
-  if options.verbose:
-    lines = groupstats(data['groups'], options.verbose)
-  else:
-    lines = stats["stats"]
-  for l in lines:
-    print("      - " + l)
-  
 
-  ### UPDATE JSON FILE
-  
-  if options.verbose: print("\nUpdate JSON output file: " + options.jsonout + "\n")
   data["info"]["mode"] = "group"
   data["info"]["grouping"] = stats
-  data["info"]["cmds"].append(cmd)
-  gcmstoolbox.saveJSON(data, options.jsonout)     # backup and safe json
-  print("\nFinalised. Wrote " + options.jsonout + "\n")
-  
-  exit()
+  return stats
 
 
 
 
-def readlist(fh, line, i, RIfixed, RIfactor, discard, minMF, minRMF, merge, verbose = False):
-  
-  global data, allocations, doubles
+def readlist(fh, line, i, spectra, allocations, doubles, RIfixed, RIfactor, discard, minMF, minRMF, merge, verbose = False):
+  # read the hits of one unknown, and allocate them to a group:
+  #   allocations: spectrum -> group number
+  #   doubles:     lowest group number -> set of groups that are possibly the same component
   
   hits = []
   processed = False
@@ -190,7 +211,7 @@ def readlist(fh, line, i, RIfixed, RIfactor, discard, minMF, minRMF, merge, verb
   
   # if selection on RI: obtain RI and RIwindow    
   if (RIfixed != 0) or (RIfactor != 0):
-    u = getRI(unknown)
+    u = getRI(spectra, unknown)
     w = RIfixed + (RIfactor * u)
   else:
     u = w = 0
@@ -204,7 +225,7 @@ def readlist(fh, line, i, RIfixed, RIfactor, discard, minMF, minRMF, merge, verb
       hit = parts[0].replace("<<", "").strip()
       
       # extract RI, match and reverse match
-      h = getRI(hit) if (w != 0) else 0
+      h = getRI(spectra, hit) if (w != 0) else 0
       hitMF, hitRMF, temp = parts[2].split("; ", 2)
       hitMF = int(hitMF.replace("MF: ", "").strip())
       hitRMF = int(hitRMF.replace("RMF: ", "").strip())
@@ -297,24 +318,22 @@ def readlist(fh, line, i, RIfixed, RIfactor, discard, minMF, minRMF, merge, verb
 
 
 
-def getRI(name):
-  global data
-  
-  if name in data['spectra']:
-    if 'RI' in data['spectra'][name]:
-      return float(data['spectra'][name]['RI'])
+def getRI(spectra, name):
+  if name in spectra:
+    if 'RI' in spectra[name]:
+      return float(spectra[name]['RI'])
     else:
       return 0
   
   #if the spectrum doesn't exist: ERROR
   else:
-    print("\n!! FATAL ERROR: spectrum " + name + " was not found in the GCMStoolbox JSON data file.\n")
+    raise gcmstoolbox.GCMSError("spectrum " + name + " was not found in the GCMStoolbox JSON data file.")
 
 
 
 
-def buildgroups(groups, g, s):
-  ri = getRI(s)
+def buildgroups(spectra, groups, g, s):
+  ri = getRI(spectra, s)
   
   if g not in groups:
     # initialise the group
@@ -334,6 +353,22 @@ def buildgroups(groups, g, s):
 
 
 
+def countsources(spectra, groups):
+  # the sources and samples are coded as integers in one pass over the spectra, so that
+  # counting the distinct values in a group only involves small integers
+  # spectra without a source (or sample) get a unique negative code: each one counts separately
+  tables, codes = gcmstoolbox.categorycodes(spectra, ["Source", "Sample"])
+  spcodes = {}
+  for n, (s, code) in enumerate(zip(spectra, codes), 1):
+    spcodes[s] = tuple(v if v >= 0 else -n for v in code)
+  
+  for group in groups.values():
+    members = [spcodes[s] for s in group["spectra"]]
+    group["sources"] = len(set(m[0] for m in members))
+    group["samples"] = len(set(m[1] for m in members))
+
+
+
 def groupstats(groups, verbose = False):
   
   # make stats
@@ -4,7 +4,10 @@
 import sys
 import os
 import ntpath
+import csv
+import time
 from collections import OrderedDict
+import traceback
 from glob import glob
 from optparse import OptionParser, OptionGroup
 import gcmstoolbox
@@ -37,17 +40,27 @@ def main():
   group.add_option("-s", "--specno",  help="Override spectrum numbering, start with I [default: 1]; the append option may override this", action="store", dest="i", default=1, type="int")
   group.add_option("-n", "--norm",    help="Normalise to a given maximum, 0 to skip normalisation [default=999])", action="store", dest="n", default=999, type="int")
   group.add_option("--allmodels",     help="For AMDIS .ELU files: import all models [not default]", action="store_true", dest="allmodels", default=False)
+  group.add_option("--sumsignals",    help="For AMDIS .ELU files: also write the sum of the signals of each file (as sumsignals.py) to a CSV file", action="store", dest="sumsignals", type="string")
+  parser.add_option_group(group)
+  
+  group = OptionGroup(parser, "WATCH", "Keep watching the import files (quote the wildcards, eg. \"data/*.elu\", so they are evaluated again) and append new or changed files to the JSON output file, until stopped with Ctrl-C. A file is imported once its size and modification time did not change for one interval; the files that are ready are imported as one batch. The JSON output file is written (as a whole) when the watch is stopped, and while watching only if --save is given.")
+  group.add_option("-w", "--watch",   help="Watch the import files, checking every WATCH seconds", action="store", dest="watch", type="float")
+  group.add_option("--batch",         help="Maximal number of files per batch [default: 100]", action="store", dest="batch", type="int", default=100)
+  group.add_option("--save",          help="While watching, write the JSON output file after a batch if the previous write is at least SAVE seconds ago [default: only when stopped]", action="store", dest="save", type="float")
   parser.add_option_group(group)
   
   group = OptionGroup(parser, "ELinC", "Special formatting options for the ELinC project")
   group.add_option("-e", "--elinc",   help="Retrieve parameters from the structured file names [not default]", action="store_true", dest="elinc", default=False)
   parser.add_option_group(group)
   
+  gcmstoolbox.profileOptions(parser)
+  
   (options, args) = parser.parse_args()
 
   ### ARGUMENTS AND OPTIONS
   
   cmd = " ".join(sys.argv)
+  gcmstoolbox.startProfile(options, cmd)
   
   if options.verbose: print("Processing import files and options")
 
@@ -55,7 +68,7 @@ def main():
   inFiles = []
   if len(args) == 0:
     print(" !! No import files?\n")
-    exit()
+    exit(1)
   else:
     for arg in args:
       inFiles.extend(glob(arg))
@@ -66,11 +79,17 @@ def main():
     else:
       if options.verbose: print(" - import file: " + inFile)
 
+  # watch mode (the import files may not exist yet)
+  if options.watch is not None:
+    watch(args, cmd, options)
+    gcmstoolbox.stopProfile()
+    exit()
+
   # number of inFiles; must not be 0
   numInFiles = len(inFiles)
   if numInFiles == 0:
     print(" !! No import files?\n")
-    exit()
+    exit(1)
   else:
     if options.verbose: print(" => " + str(numInFiles) + " import files")
 
@@ -78,69 +97,258 @@ def main():
  
   if options.append:
     data = gcmstoolbox.openJSON(options.jsonout)
-
-    # check if it is a spectra file (cannot append to groups file)
-    if data['info']['mode'] != "spectra": 
-      print(" !! Cannot append to a '" + data['info']['mode'] + "' mode data file.\n")
-      exit()
     
     # add administration to specta[0] (info)
     data['info']['cmds'].append(cmd)
-    data['info']['sources'].extend(inFiles)
-    
-    # spectrum number counter  (remark: len(spectra) is always one count higher than the number of spectra; spectra[0] is info!)
-    if len(data['spectra']) < options.i:
-      i = options.i
-    else:
-      i = len(data['spectra']) + 1
+    data['info'].setdefault('sources', []).extend(inFiles)
   else:
-    cmds = [cmd]
-    data = OrderedDict()
-    data['info'] = OrderedDict([('mode', 'spectra'), ('cmds', cmds)])
-    data['spectra'] = OrderedDict()
-    i = options.i # spectrum number
+    data = newdata()
+    data['info']['cmds'].append(cmd)
     
   if options.elinc and options.verbose: print(" => ELinC special formatting is set")
+
+  # sum of signals for each ELU file (source -> spectra count, IS, XN, AM, RA)
+  signals = OrderedDict() if options.sumsignals else None
  
   
+  ### IMPORT SPECTRA
+
+  try:
+    with gcmstoolbox.stage("parse", unit="spectra") as record:
+      record['items'] = importspectra(data, inFiles, options.i, options.n, options.elinc, options.allmodels, signals, 
+                                      verbose=options.verbose, progress=True)
+  except gcmstoolbox.GCMSError as e:
+    print("\n !! " + str(e) + "\n")
+    exit(1)
+        
+        
+  ### SUM OF SIGNALS
+
+  if signals is not None:
+    print("\nWriting sum of signals")
+    writesumsignals(options.sumsignals, signals)
+    print(" => Wrote " + options.sumsignals)
+
+  
+  ### WRITE SPECTRA JSON 
+  
+  print("\nWriting data file")
+  gcmstoolbox.saveJSON(data, options.jsonout)
+  
+  print(" => Finalised. Wrote " + options.jsonout + "\n")
+  gcmstoolbox.stopProfile()
+  exit()
+
+
+
+def watch(patterns, cmd, options):
+  # watch the import files (patterns with wildcards), and append new or changed files in batches
+  # to the JSON output file; the state (size and modification time) of each imported file
+  # (and the numbers of its spectra) is kept in data['info']['watched'], so that a restarted watch
+  # continues where it stopped
+  # the data file is written when stopped, and after a batch if the previous write is at least
+  # options.save seconds ago (if given)
+  jsonout = options.jsonout
+  if os.path.isfile(jsonout):
+    data = gcmstoolbox.openJSON(jsonout)
+  else:
+    data = newdata()
+  if data['info']['mode'] != "spectra": 
+    print(" !! Cannot append to a '" + data['info']['mode'] + "' mode data file.\n")
+    exit(1)
+  data['info']['cmds'].append(cmd)
+  watched = data['info'].setdefault('watched', OrderedDict())
+  
+  # files that were imported before watching (same path) are not imported again
+  sources = data['info'].setdefault('sources', [])
+  imported = set(os.path.abspath(source) for source in sources)
+  seen = {}         # file -> state at the previous check
+  backup = True     # only the first write of the data file makes a backup
+  unsaved = False   # batches imported after the last write
+  saved = time.time()
+  
+  print("Watching " + " ".join(patterns) + " (stop with Ctrl-C)\n")
+  try:
+    while True:
+      # files that are new or changed, and did not change since the previous check
+      current = {}
+      ready = []
+      for pattern in patterns:
+        for inFile in glob(pattern):
+          if os.path.isdir(inFile) or (inFile in current): continue
+          stat = os.stat(inFile)
+          state = [stat.st_size, stat.st_mtime]
+          current[inFile] = state
+          path = os.path.abspath(inFile)
+          if watched.get(path, [])[:2] == state:
+            continue
+          if (path not in watched) and (path in imported):
+            watched[path] = state
+            continue
+          if seen.get(inFile) == state:
+            ready.append(inFile)
+      seen = current
+      
+      # import a batch; the other files wait for the next check
+      ready = sorted(ready)[:options.batch]
+      if len(ready) > 0:
+        t = time.time()
+        signals = OrderedDict() if options.sumsignals else None
+        last = max((int(sp['DB#']) for sp in data['spectra'].values()), default=0)
+        try:
+          with gcmstoolbox.stage("parse batch", unit="spectra") as record:
+            count = record['items'] = importbatch(data, OrderedDict((inFile, current[inFile]) for inFile in ready), watched, 
+                                                  options.i, options.n, options.elinc, options.allmodels, signals, options.verbose)
+        except (Exception, KeyboardInterrupt) as e:
+          # the spectra of the failed batch are removed again: its files are not marked as imported,
+          # and are imported again by a next watch; the batches before are saved
+          for key in [key for key, sp in data['spectra'].items() if int(sp['DB#']) > last]:
+            del data['spectra'][key]
+          unsaved = True
+          if isinstance(e, KeyboardInterrupt): raise
+          if isinstance(e, gcmstoolbox.GCMSError): print("\n !! " + str(e) + "\n")
+          else:                                    traceback.print_exc()
+          gcmstoolbox.saveJSON(data, jsonout, backup)
+          print(" => Wrote " + jsonout + "\n")
+          exit(1)
+        for inFile in ready:
+          if os.path.abspath(inFile) not in imported:
+            imported.add(os.path.abspath(inFile))
+            sources.append(inFile)
+        unsaved = True
+        
+        if signals is not None:
+          writesumsignals(options.sumsignals, OrderedDict((source, list(totals.values())) for source, totals in data['info']['sumsignals'].items()))
+        print(time.strftime("%H:%M:%S") + " => Imported {} spectra from {} files in {:.1f} s".format(count, len(ready), time.time() - t))
+        if (options.save is not None) and (time.time() - saved >= options.save):
+          gcmstoolbox.saveJSON(data, jsonout, backup)
+          backup = False
+          unsaved = False
+          saved = time.time()
+          print(time.strftime("%H:%M:%S") + " => Wrote " + jsonout)
+      
+      time.sleep(options.watch)
+  
+  except KeyboardInterrupt:
+    print("\n => Stopped watching")
+  
+  if unsaved:
+    gcmstoolbox.saveJSON(data, jsonout, backup)
+    print(" => Wrote " + jsonout + "\n")
+
+
+
+def importbatch(data, inFiles, watched, i=1, norm=999, elinc=False, allmodels=False, signals=None, verbose=False):
+  # (re)import a batch of files (file -> size and modification time): the spectra of files that
+  # were imported before are replaced
+  # watched: absolute path -> size, modification time, first and last spectrum number (DB#) of the
+  # spectra of the file; the entries of the files are updated
+  # returns the number of imported spectra
+  paths = OrderedDict((os.path.abspath(inFile), inFile) for inFile in inFiles)
+  numbers = set()   # spectrum numbers of the files
+  sources = set()   # file names of the files that were imported before watching (no spectrum numbers)
+  for path, inFile in paths.items():
+    if len(watched.get(path, [])) == 4:
+      numbers.update(range(watched[path][2], watched[path][3] + 1))
+    elif path in watched:
+      sources.add(os.path.basename(inFile))
+  if (len(numbers) > 0) or (len(sources) > 0):
+    for key in [key for key, sp in data['spectra'].items() if (int(sp['DB#']) in numbers) or (sp.get('Source') in sources)]:
+      del data['spectra'][key]
+  
+  ranges = {}
+  count = importspectra(data, list(inFiles), i, norm, elinc, allmodels, signals, ranges, verbose=verbose)
+  for path, inFile in paths.items():
+    watched[path] = list(inFiles[inFile]) + ranges[inFile]
+  return count
+
+
+
+def writesumsignals(outfile, signals):
+  # write the sum of signals (source -> spectra count, IS, XN, AM, RA) to a CSV file, as sumsignals.py
+  with open(outfile, 'w', newline='') as fh:
+    mkreport = csv.writer(fh, dialect='excel')
+    gcmstoolbox.sumsignalsHeader(mkreport)
+    for source, totals in signals.items():
+      mkreport.writerow(gcmstoolbox.sumsignalsRow(source, *totals))
+
+
+
+def newdata():
+  # new (empty) GCMStoolbox data file
+  data = OrderedDict()
+  data['info'] = OrderedDict([('mode', 'spectra'), ('cmds', [])])
+  data['spectra'] = OrderedDict()
+  return data
+
+
+
+def importspectra(data, inFiles, i=1, norm=999, elinc=False, allmodels=False, signals=None, ranges=None, verbose=False, progress=False):
+  # import the spectra of the given files into data (see newdata); the numbering starts at i,
+  # or after the highest spectrum number that is already in data
+  #   norm:      normalise to this maximum, 0 to skip normalisation
+  #   elinc:     retrieve parameters from the structured (ELinC) file names
+  #   allmodels: for AMDIS .ELU files: import all models, not only the one with the lowest OR
+  #   signals:   if a dict is given, the sum of the signals of each ELU file is collected in it
+  #              (source -> spectra count, IS, XN, AM, RA), and kept in data['info']['sumsignals']
+  #   ranges:    if a dict is given, the first and last spectrum number of each file are kept in it
+  #              (file -> [first, last], last < first if the file has no spectra)
+  # returns the number of imported spectra (progress: show the progress on the terminal)
+
+  # check if it is a spectra file (cannot append to groups file)
+  if data['info']['mode'] != "spectra": 
+    raise gcmstoolbox.GCMSError("Cannot append to a '" + data['info']['mode'] + "' mode data file.")
+    
+  # spectrum number counter: continue after the highest number in data, so that spectra that
+  # are replaced (see importbatch) never get the number of another spectrum
+  last = max((int(sp['DB#']) for sp in data['spectra'].values()), default=0)
+  if (len(data['spectra']) > 0) and (last >= i):
+    i = last + 1
+  count = len(data['spectra'])
+
+  bar = progress and not verbose   # progress bars
+  
+  
   ### ITERATE THROUGH INFILES
   
   # init progress bar
-  if not options.verbose: 
+  if bar: 
     print("\nProcessing files")
     j = 0
     k = len(inFiles)
     gcmstoolbox.printProgress(j, k)
   
   for inFile in inFiles:
-    if options.verbose: print("\nProcessing file: " + inFile)
+    if verbose: print("\nProcessing file: " + inFile)
+    path = inFile
+    if ranges is not None: ranges[path] = [i, i - 1]
 
     with open(inFile,'r') as fh:   #file handle closes itself 
       lastSpectrum = False
       while True:
         # read spectra
         inFile = os.path.basename(inFile)
-        spectrum = readspectrum(fh, inFile, norm=options.n, elinc=options.elinc, verbose=options.verbose)
+        spectrum = readspectrum(fh, inFile, norm=norm, elinc=elinc, verbose=verbose, signals=signals, allmodels=allmodels)
         
         # break from while loop if readspectrum returns False (<= EOF)
         if spectrum == "eof": 
           break
 
         # apply special ELinC formatting
-        if options.elinc:
-          elincize(spectrum, inFile, verbose=options.verbose)
+        if elinc:
+          elincize(spectrum, inFile, verbose=verbose)
 
-        # store only the Amdis model with the lowest OR (except if options.allmodels command line option is active)
-        if not options.allmodels and ('OR' in spectrum) and ('RI' in spectrum):
+        # store only the Amdis model with the lowest OR (except if the allmodels option is active)
+        if not allmodels and ('OR' in spectrum) and ('RI' in spectrum):
           # check if the previous spectrum in the the ELU file is another model for the same scan (same RI, other OR)
           if lastSpectrum:
             if spectrum['RI'] == data['spectra'][lastSpectrum]['RI']:
               # if the new spectrum has higher OR than the stored spectrum, skip this one
               if spectrum['OR'] >= data['spectra'][lastSpectrum]['OR']:
-                if options.verbose: print("    - Skipping: a more likely model is already stored")
+                if verbose: print("    - Skipping: a more likely model is already stored")
                 continue
               else:
-                if options.verbose: print("    - Replacing an already stored less likely model")
+                if verbose: print("    - Replacing an already stored less likely model")
                 # it's a bit messy, but in order to overwrite a spectrum we need to 
                 del data['spectra'][lastSpectrum]  # (1) remove the old
                 i -= 1                             # (2) reduce the iterator
@@ -157,24 +365,25 @@ def main():
         
         # increase spectrum number
         i += 1
+        if ranges is not None: ranges[path][1] = i - 1
           
     # adjust progress bar
-    if not options.verbose: 
+    if bar: 
       j += 1
       gcmstoolbox.printProgress(j, k)      
-        
-        
-  ### WRITE SPECTRA JSON 
-  
-  print("\nWriting data file")
-  gcmstoolbox.saveJSON(data, options.jsonout)
-  
-  print(" => Finalised. Wrote " + options.jsonout + "\n")
-  exit()
 
+  # keep the sum of signals in the data file
+  if signals is not None:
+    if 'sumsignals' not in data['info']:
+      data['info']['sumsignals'] = OrderedDict()
+    for source, totals in signals.items():
+      data['info']['sumsignals'][source] = OrderedDict(zip(['count', 'IS', 'XN', 'AM', 'RA'], totals))
+
+  return len(data['spectra']) - count
 
 
-def readspectrum(fh, inFile,norm = 999, elu = False, elinc=False, verbose = False):
+
+def readspectrum(fh, inFile,norm = 999, elu = False, elinc=False, verbose = False, signals = None, allmodels = False):
   # we expect that each spectrum starts with 'name' (case insensitive)
   # we use this as a trigger to start recording the metadata, reading the filehandle line by line  numpeaks is reached, we return the data as a dictonary
   
@@ -213,7 +422,7 @@ def readspectrum(fh, inFile,norm = 999, elu = False, elinc=False, verbose = Fals
           
           elif nextline.casefold().startswith('num peaks'):  #numpeaks: switch from readmeta to readdata mode
             # time to extract extra information for elu and elinc files 
-            if elu:   eluFile(spectrum, inFile)
+            if elu:   eluFile(spectrum, inFile, signals, allmodels)
             if elinc: elincize(spectrum, inFile, verbose = False)
  
             # final piece of metadata; we'll add this to spectrum after normalisation and recalculation!!
@@ -299,10 +508,12 @@ def readspectrum(fh, inFile,norm = 999, elu = False, elinc=False, verbose = Fals
 
 
 
-def eluFile(spectrum, inFile):
+def eluFile(spectrum, inFile, signals = None, allmodels = False):
   # example "|SC15|CN2|MP1-MODN:81(%84.3)|AM25664|PC32|SN27|WD5.4|TA4.5|TR14.0|FR12-20|RT2.1366|MN2.7|RA0.00403|IS394917|XN425813|RI740.7|MO4: 81 79 77 96|EW1-0|FG0.843|TN3.585|OR1|NT1"
+  # if signals is given (dict), the IS, XN, AM and RA of the first model (or all models) are added to the totals of inFile
   
   eluNameParts = spectrum['Name'].split('|')
+  other = {}
   for p in eluNameParts:
     if   p.startswith('RI'): spectrum['RI'] = p[2:]  # retention index
     elif p.startswith('RT'): spectrum['RT'] = p[2:]  # retention time
@@ -311,8 +522,21 @@ def eluFile(spectrum, inFile):
     elif p.startswith('SN'): spectrum['SN'] = p[2:]  # signal to noise ratio
     elif p.startswith('MP'): spectrum['MP'] = p[2:]  # Amdis model peak information
     elif p.startswith('OR'): spectrum['OR'] = p[2:]  # order number of Amdis models (lower = higher probability)
+    elif p.startswith('XN'): other['XN'] = p[2:]     # area (only for the sum of signals)
+    elif p.startswith('AM'): other['AM'] = p[2:]     # base peak abundance (only for the sum of signals)
   
-  spectrum['Source'] = inFile
+  spectrum['Source'] = sys.intern(inFile)
+
+  if signals is not None:
+    if inFile not in signals:
+      signals[inFile] = [0, 0, 0, 0, 0.0]
+    if allmodels or (int(spectrum.get('OR', 1)) == 1):
+      totals = signals[inFile]
+      totals[0] += 1
+      totals[1] += int(spectrum.get('IS', 0))
+      totals[2] += int(other.get('XN', 0))
+      totals[3] += int(other.get('AM', 0))
+      totals[4] += float(spectrum.get('RA', 0))
   
   spectrum['Name'] = (   (( "RI=" + spectrum['RI']) if 'RI' in spectrum else "")
                        + ((" IS=" + spectrum['IS']) if 'IS' in spectrum else "")
@@ -345,23 +569,20 @@ def elincize(spectrum, inFile, verbose = False):
 
   # error checks
   if len(parts) < 7:
-    print("\n ! ELinCize failed: not enough parts in " + base + "\n")
-    exit()
+    raise gcmstoolbox.GCMSError("ELinCize failed: not enough parts in " + base)
   if parts[3][:-1].isdigit() == False:
-    print("\n ! ELinCize failed: artificial aging code incorrect in " + base + "\n")
-    exit()
+    raise gcmstoolbox.GCMSError("ELinCize failed: artificial aging code incorrect in " + base)
   if len(parts[6]) != 3:
-    print("\n ! ELinCize failed: incorrect pyrolysis temperature in " + base + "\n")
-    exit()  
+    raise gcmstoolbox.GCMSError("ELinCize failed: incorrect pyrolysis temperature in " + base)
   
-  #(re)build fields
-  spectrum['Sample'] = parts[1] + "-" + parts[2] + "-" + parts[3] + "-" + parts[6]
+  #(re)build fields (interned: the same values are shared by all spectra, see gcmstoolbox.categorical)
+  spectrum['Sample'] = sys.intern(parts[1] + "-" + parts[2] + "-" + parts[3] + "-" + parts[6])
   spectrum['Resin']  = gcmstoolbox.resin[parts[1]]
-  spectrum['AAdays'] = parts[3][:-1]
-  spectrum['Color']  = parts[3][-1:]
-  spectrum['PyTemp'] = parts[6]
+  spectrum['AAdays'] = sys.intern(parts[3][:-1])
+  spectrum['Color']  = sys.intern(parts[3][-1:])
+  spectrum['PyTemp'] = sys.intern(parts[6])
   
-  spectrum['Source'] = inFile
+  spectrum['Source'] = sys.intern(inFile)
   
   spectrum['Name']   = (   (( "RI=" + spectrum['RI']) if 'RI' in spectrum else "")
                          + ((" IS=" + spectrum['IS']) if 'IS' in spectrum else "")
@@ -1,10 +1,17 @@
 #! /usr/bin/env python
 # -*- coding: utf-8 -*-
 
-#import sys
-#import os
-#import csv
+import sys
+import os
+import csv
 import re
+import io
+import json
+import mmap
+import tarfile
+import zipfile
+import multiprocessing
+from collections import OrderedDict
 #from glob import glob
 from optparse import OptionParser, OptionGroup
 import gcmstoolbox
@@ -29,77 +36,324 @@ def main():
   
   parser = OptionParser(usage, version="GCMStoolbox version " + gcmstoolbox.version + " (" + gcmstoolbox.date + ")\n")
   parser.add_option("-v", "--verbose", help="Be very verbose [not default]", action="store_true", dest="verbose", default=False)
-  parser.add_option("-n", "--name",    help="Search spectra on name", action="store", dest="search_name", type="string")
-  parser.add_option("-r", "--ri",      help="Search on retention index", action="store", dest="search_ri", type="string")
+  parser.add_option("-n", "--name",    help="Search spectra on name (case insensitive, part of the name)", action="store", dest="search_name", type="string")
+  parser.add_option("-r", "--ri",      help="Search on retention index (+/- 0.5) or RI range (eg. 1200-1250)", action="store", dest="search_ri", type="string")
   parser.add_option("-c", "--cas",     help="Search on CAS number", action="store", dest="search_cas", type="string")
+  parser.add_option("-o", "--output",  help="Write all text files into one archive: a .zip, .tar or .tar.gz file, or else one concatenated text file with an index (OUTPUT-index.csv); of the spectra with the same text file name, only the last one is written (as without this option)", action="store", dest="output", type="string")
+  parser.add_option("-j", "--jobs",    help="Number of parallel worker processes [default: 1]", action="store", dest="jobs", type="int", default=1)
+  
+  gcmstoolbox.profileOptions(parser)
   
   (options, args) = parser.parse_args()
 
 
   ### ARGUMENTS AND OPTIONS
 
+  cmd = " ".join(sys.argv)
+  gcmstoolbox.startProfile(options, cmd)
+
   # make a list of input files
   if len(args) == 0:
     print(" !! No NIST file?\n")
-    exit()
+    exit(1)
   elif len(args) > 1:
     print(" !! Too many NIST files!\n")
-    exit()
+    exit(1)
   else:
     inFile = args[0]
   
+  if options.search_ri is not None:
+    try:
+      rirange(options.search_ri)
+    except ValueError:
+      print(" !! Invalid retention index or range: " + options.search_ri + " (eg. 1200 or 1200-1250)\n")
+      exit(1)
+  
 
-  ### READ FILE
+  ### SELECT SPECTRA
+  
+  query = (options.search_name is not None) or (options.search_ri is not None) or (options.search_cas is not None)
+  with gcmstoolbox.stage("index", unit="spectra") as record:
+    if query:
+      # the byte offsets of the matching spectra are looked up in the index (built if needed)
+      index = readindex(inFile, options.verbose)
+      offsets = search(index, options.search_name, options.search_ri, options.search_cas)
+      print("Found " + str(len(offsets)) + " spectra")
+    else:
+      # all spectra
+      offsets = scanoffsets(inFile)
+    # a spectrum overwrites the text file of an earlier spectrum with the same file name: only the
+    # last spectrum of each file name is converted, so that the archives have no duplicate names
+    offsets = lastnames(inFile, offsets)
+    record['items'] = len(offsets)
+  
+
+  ### CONVERT SPECTRA
   if options.verbose: print("\nProcessing file: " + inFile)
   
-  with open(inFile,'r', encoding="latin-1") as fh:   #file handle closes itself
-    for line in fh: 
-   
-      # FIRST LINE
+  # the spectra are converted in chunks (with --jobs, by worker processes), and written in order
+  chunks = [(inFile, offsets[c:c+chunksize], options.verbose) for c in range(0, len(offsets), chunksize)]
+  if options.jobs > 1:
+    pool = multiprocessing.Pool(options.jobs)
+    blocks = pool.imap(convertchunk, chunks)
+  else:
+    pool = None
+    blocks = (convertchunk(chunk) for chunk in chunks)
+  
+  with gcmstoolbox.stage("convert", len(offsets), "spectra"):
+    if options.output is None:
+      for block in blocks:
+        for outfn, text, name in block:
+          with open(outfn, "w") as outfh:
+            outfh.write(text)
+    else:
+      n = writearchive(options.output, blocks)
+      print("\n => Wrote {} spectra to {}\n".format(n, options.output))
+  
+  if pool is not None:
+    pool.close()
+    pool.join()
+  
+  gcmstoolbox.stopProfile()
+
+
+
+chunksize = 1000
+namepattern = re.compile(rb"^name", re.IGNORECASE | re.MULTILINE)
+peakpattern = re.compile(r"[-+]?[.]?[\d]+(?:,\d\d\d)*[\.]?\d*(?:[eE][-+]?\d+)?")
+separators = str.maketrans(";:()\t", "     ")
+
+def scanoffsets(inFile):
+  # byte offsets of all spectra (lines starting with "name") in a NIST file
+  if os.path.getsize(inFile) == 0: return []
+  with open(inFile, 'rb') as fh:
+    with mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+      return [m.start() for m in namepattern.finditer(mm)]
+
+
+
+def lastnames(inFile, offsets):
+  # the offsets of the spectra of which no later spectrum has the same text file name
+  last = {}
+  with open(inFile, 'rb') as fh:
+    for offset in offsets:
+      fh.seek(offset)
+      last[txtname(fh.readline().decode("latin-1").split(':', 1)[1].strip())] = offset
+  keep = set(last.values())
+  return [offset for offset in offsets if offset in keep]
+
+
+
+def convertchunk(task):
+  # read the spectra at a list of byte offsets; returns (filename, text, spectrum name) tuples (used by the worker processes)
+  inFile, offsets, verbose = task
+  converted = []
+  with open(inFile, 'rb') as fh:
+    for offset in offsets:
+      fh.seek(offset)
+      lines = (line.decode("latin-1") for line in fh)
+      name, values = readrecord(lines, next(lines), verbose)
+      converted.append((txtname(name), formattxt(values), name))
+  return converted
+
+
+
+def writearchive(output, blocks):
+  # write the converted spectra into a zip or tar archive, or a concatenated text file with a
+  # csv index (file, spectrum name, byte offset and length of its text); returns the number of spectra
+  # (the file names must be unique, see lastnames)
+  n = 0
+  lower = output.casefold()
+  if lower.endswith(".zip"):
+    with zipfile.ZipFile(output, "w", zipfile.ZIP_DEFLATED) as zf:
+      for block in blocks:
+        for outfn, text, name in block:
+          zf.writestr(outfn, text)
+          n += 1
+  elif lower.endswith((".tar", ".tar.gz", ".tgz")):
+    with tarfile.open(output, "w" if lower.endswith(".tar") else "w:gz") as tf:
+      for block in blocks:
+        for outfn, text, name in block:
+          data = text.encode("utf-8")
+          info = tarfile.TarInfo(outfn)
+          info.size = len(data)
+          tf.addfile(info, io.BytesIO(data))
+          n += 1
+  else:
+    indexfile = os.path.splitext(output)[0] + "-index.csv"
+    with open(output, "wb") as fh, open(indexfile, "w", newline='') as ih:
+      mkindex = csv.writer(ih, dialect='excel')
+      mkindex.writerow(["file", "name", "offset", "length"])
+      offset = 0
+      for block in blocks:
+        for outfn, text, name in block:
+          data = text.encode("utf-8")
+          fh.write(data)
+          mkindex.writerow([outfn, name, offset, len(data)])
+          offset += len(data)
+          n += 1
+    print("\n => Wrote the index to " + indexfile)
+  return n
+
+
+
+def readrecord(lines, line, verbose = False):
+  # read a spectrum from an iterator of lines, starting with its Name line; returns name and x/y values
+  
+  # FIRST LINE
+  name = line.split(':', 1)[1].strip()
+  count = 0
+  values = []
+  if verbose: print("  Spectrum: " + name)
+
+  # OTHER METADATA
+  for nextline in lines:
+    if nextline.casefold().startswith('num peaks'):
+      count = int(nextline.split(':', 1)[1].strip())
+      break
+
+  # READ SPECTRUM
+  for nextline in lines:
+    # plain integer peak lists ("41 120; 43 999;" or "(41 120) (43 999)") are split directly,
+    # anything else (decimals, exponents, thousands separators...) goes through the regex
+    fields = nextline.translate(separators).split()
+    if all(field.isdecimal() for field in fields):
+      values.extend(fields)
+    else:
+      values.extend(peakpattern.findall(nextline))
+
+    if len(values) == count * 2 :
+      break
+
+    if len(nextline.strip()) == 0:
+      print ( "WARNING - count " + str(count) + " - values " + str(len(values)))
+      break
+
+  return name, values
+
+
+
+def txtname(name):
+  # text file name for a spectrum
+  keepcharacters = (' ','.','_')
+  return "".join(c for c in name if c.isalnum() or c in keepcharacters).rstrip() + ".txt"
+
+
+
+def formattxt(values):
+  # x;y lines for a flat list of x/y values
+  pairs = len(values) // 2
+  return "".join(x + ";" + y + "\n" for x, y in zip(values[0:2*pairs:2], values[1:2*pairs:2]))
+
+
+
+def readmeta(nextline, cas, ri):
+  # CAS# and RI from a metadata line
+  if nextline.casefold().startswith('cas#'):
+    #NOTE: NIST seems to store sometimes CAS# and NIST# on the same line, CAS# first and then NIST# 
+    #      separated with semicolon. I haven't seen AMDIS doing this. I hope this is the only case?
+    if 'nist#' in nextline.casefold():
+      parts = nextline.split(';', 1)
+      cas = parts[0].split(':', 1)[1].strip()
+    else:
+      cas = nextline.split(':', 1)[1].strip()
+  elif nextline.casefold().startswith('ri'):
+    ri = nextline.split(':', 1)[1].strip()
+  return cas, ri
+
+
+
+def tokens(name):
+  # lowercase alphanumeric words in a name
+  return re.findall("[0-9a-z]+", name.casefold())
+
+
+
+def makeindex(inFile, verbose = False):
+  # index of a NIST file: byte offset, name, CAS# and RI of each spectrum, and name tokens -> spectra
+  if verbose: print("Indexing " + inFile)
+  records = []
+  with open(inFile, 'rb') as fh:
+    offset = 0
+    for bline in fh:
+      line = bline.decode("latin-1")
       if line.casefold().startswith('name'):
-        name = line.split(':', 1)[1].strip()
-        ri = ""
-        cas = ""
-        count = 0
-        values = []
-        if options.verbose: print("  Spectrum: " + name)
-
-        # OTHER METADATA
-        for nextline in fh:
-          if nextline.casefold().startswith('cas#'):
-              #NOTE: NIST seems to store sometimes CAS# and NIST# on the same line, CAS# first and then NIST# 
-              #      separated with semicolon. I haven't seen AMDIS doing this. I hope this is the only case?
-              if 'nist#' in nextline.casefold():
-                parts = nextline.split(';', 1)
-                cas = parts[0].split(':', 1)[1].strip()
-              else:
-                cas = nextline.split(':', 1)[1].strip()
-          elif nextline.casefold().startswith('ri'):
-            ri = nextline.split(':', 1)[1].strip()
-          elif nextline.casefold().startswith('num peaks'):
-            count = int(nextline.split(':', 1)[1].strip())
-            break
-        
-        # EVALUATE QUERY CONDITION
-        # todo
-
-        # READ SPECTRUM
-        for nextline in fh:
-          values.extend(re.findall("[-+]?[.]?[\d]+(?:,\d\d\d)*[\.]?\d*(?:[eE][-+]?\d+)?", nextline))
-
-          if len(values) == count * 2 :
-            break
-
-          if len(nextline.strip()) == 0:
-            print ( "WARNING - count " + str(count) + " - values " + str(len(values)))
-            break
-
-        # WRITE TEXT FILE
-        keepcharacters = (' ','.','_')
-        outfn = "".join(c for c in name if c.isalnum() or c in keepcharacters).rstrip() + ".txt"
-        with open(outfn, "w") as outfh:
-          for x in range(count):
-            outfh.write(values.pop(0) + ";" + values.pop(0) + "\n")
+        records.append([offset, line.split(':', 1)[1].strip(), "", ""])
+      elif (len(records) > 0) and (records[-1][2] == "" or records[-1][3] == ""):
+        records[-1][2], records[-1][3] = readmeta(line, records[-1][2], records[-1][3])
+      offset += len(bline)
+  
+  names = {}
+  for k, record in enumerate(records):
+    for token in set(tokens(record[1])):
+      names.setdefault(token, []).append(k)
+  
+  stat = os.stat(inFile)
+  return OrderedDict([('size', stat.st_size), ('mtime', stat.st_mtime), ('records', records), ('names', names)])
+
+
+
+def readindex(inFile, verbose = False):
+  # read the index of a NIST file (inFile.idx), and (re)build it if it is missing or outdated
+  idxfile = inFile + ".idx"
+  stat = os.stat(inFile)
+  if os.path.isfile(idxfile):
+    with open(idxfile, 'r') as fh:
+      index = json.load(fh)
+    if (index['size'] == stat.st_size) and (index['mtime'] == stat.st_mtime):
+      return index
+  
+  index = makeindex(inFile, verbose)
+  with open(idxfile, 'w') as fh:
+    json.dump(index, fh)
+  return index
+
+
+
+def search(index, name = None, ri = None, cas = None):
+  # byte offsets of the spectra that match all given criteria:
+  #   name: case insensitive substring of the name
+  #   ri:   retention index (+/- 0.5) or range (eg. 1200-1250)
+  #   cas:  CAS number
+  records = index['records']
+  selection = range(len(records))
+  
+  if name is not None:
+    query = name.casefold()
+    # each word of the query is part of a name token of the matching spectra: the spectra with
+    # tokens that contain all query words are the candidates, which are checked on the substring
+    for word in tokens(name):
+      candidates = set()
+      for token, spectra in index['names'].items():
+        if word in token: candidates.update(spectra)
+      selection = candidates.intersection(selection)
+    selection = [k for k in sorted(selection) if query in records[k][1].casefold()]
+  
+  if cas is not None:
+    selection = [k for k in selection if records[k][2] == cas.strip()]
+  
+  if ri is not None:
+    low, high = rirange(ri)
+    selection = [k for k in selection if (records[k][3] != "") and (low <= riValue(records[k][3]) <= high)]
+  
+  return [records[k][0] for k in selection]
+
+
+
+def rirange(ri):
+  # retention index (+/- 0.5) or range (eg. 1200-1250) -> (low, high); ValueError if invalid
+  if "-" in ri:
+    low, high = [float(x) for x in ri.split("-", 1)]
+  else:
+    low, high = float(ri) - 0.5, float(ri) + 0.5
+  return low, high
+
+
+
+def riValue(ri):
+  try:               return float(ri)
+  except ValueError: return -1
+
 
 
 if __name__ == "__main__":
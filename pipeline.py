@@ -0,0 +1,155 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import sys
+import os
+import json
+import shlex
+import time
+import importlib
+import traceback
+from optparse import OptionParser
+import gcmstoolbox
+
+
+def main():
+  print("\n*******************************************************************************")
+  print(  "* GCMStoolbox - a set of tools for GC-MS data analysis                        *")
+  print(  "*   Version: {} ({})                                             *".format(gcmstoolbox.version, gcmstoolbox.date))
+  print(  "*   Author:  Wim Fremout, Royal Institute for Cultural Heritage               *")
+  print(  "*   Licence: GNU GPL version 3                                                *")
+  print(  "*                                                                             *")
+  print(  "* PIPELINE:                                                                   *")
+  print(  "*   runs a series of GCMStoolbox commands on in-memory data files, which are  *")
+  print(  "*   only written at the checkpoints                                           *")
+  print(  "*                                                                             *")
+  print(  "*******************************************************************************\n")
+
+
+  ### OPTIONPARSER
+
+  usage = "usage: %prog [options] PIPELINEFILE"
+
+  parser = OptionParser(usage, version="GCMStoolbox version " + gcmstoolbox.version + " (" + gcmstoolbox.date + ")\n")
+  parser.add_option("-c", "--checkpoints", help="Write the data files after every stage [not default]", action="store_true", dest="checkpoints", default=False)
+
+  gcmstoolbox.profileOptions(parser)
+  
+  (options, args) = parser.parse_args()
+
+
+  ### ARGUMENTS AND OPTIONS
+
+  cmd = " ".join(sys.argv)
+  gcmstoolbox.startProfile(options, cmd)
+
+  # pipeline file
+  if len(args) == 0:
+    print(" !! No pipeline file?\n")
+    exit(1)
+  elif len(args) >= 2:
+    print("  !! Too many arguments. Only one pipeline file can be processed.")
+    exit(1)
+  elif os.path.isfile(args[0]):
+    stages = readpipeline(args[0])
+  else:
+    print("  !! Pipeline file " + args[0] +  " not found.")
+    exit(1)
+
+
+  ### RUN STAGES
+
+  # the data files stay in memory between the stages
+  gcmstoolbox.keepJSON()
+  start = time.time()
+
+  for k, stage in enumerate(stages):
+    print("\n===============================================================================")
+    print(  "STAGE {}: {} {}".format(k + 1, stage['run'], " ".join(stage['args'])))
+    print(  "===============================================================================")
+
+    t = time.time()
+    with gcmstoolbox.stage("stage {}: {}".format(k + 1, stage['run'])):
+      ok = runstage(stage['run'], stage['args'])
+    if not ok:
+      print("\n  !! Stage {} ({}) did not finish; the pipeline is stopped.".format(k + 1, stage['run']))
+      checkpoint()
+      gcmstoolbox.stopProfile()
+      exit(1)
+    print("\n => Stage {} took {:.1f} s".format(k + 1, time.time() - t))
+
+    if stage['checkpoint'] or options.checkpoints:
+      checkpoint()
+
+  # final checkpoint
+  checkpoint()
+  print("\n => Pipeline of {} stages took {:.1f} s\n".format(len(stages), time.time() - start))
+  gcmstoolbox.stopProfile()
+
+
+
+# the GCMStoolbox commands that can be used in a pipeline (module names)
+commands = ["import", "group", "filter", "build", "export", "report"]
+
+def readpipeline(pipelinefile):
+  # read a pipeline file (JSON): a list of stages, each with the command to run, its arguments
+  # (a list or a command line string) and optionally a checkpoint, eg.
+  #   {"stages": [
+  #     {"run": "import", "args": "-o elinc.json -e data/*.elu"},
+  #     {"run": "group",  "args": ["-i", "elinc.json", "mspepsearch.txt"], "checkpoint": true},
+  #     {"run": "build",  "args": "-i elinc.json"},
+  #     {"run": "export", "args": "-i elinc.json elinc.msp"}
+  #   ]}
+  with open(pipelinefile, 'r') as fh:
+    spec = json.load(fh)
+
+  stages = []
+  for k, stage in enumerate(spec.get('stages', []) if isinstance(spec, dict) else spec):
+    run = str(stage.get('run', '')).lower()
+    if run.endswith(".py"): run = run[:-3]
+    if run not in commands:
+      print("  !! Stage {}: unknown command '{}' (use {}).\n".format(k + 1, stage.get('run', ''), ", ".join(commands)))
+      exit(1)
+    args = stage.get('args', [])
+    if isinstance(args, str): args = shlex.split(args)
+    stages.append({'run': run, 'args': [str(arg) for arg in args], 'checkpoint': bool(stage.get('checkpoint', False))})
+
+  if len(stages) == 0:
+    print("  !! No stages in pipeline file " + pipelinefile + "\n")
+    exit(1)
+  return stages
+
+
+
+def runstage(run, args):
+  # run the main() of a GCMStoolbox command with the given arguments; it succeeded if it returned
+  # or exited with status 0 (the commands exit with status 1 after an error); an exception is
+  # printed, and the stage failed
+  module = importlib.import_module(run)    # importlib, as "import" cannot be imported otherwise
+  nested = gcmstoolbox.profile['nested'] if gcmstoolbox.profile is not None else None
+  argv = sys.argv
+  sys.argv = [os.path.join(os.path.dirname(argv[0]), run + ".py")] + args   # as if called from the command line
+  try:
+    module.main()
+    ok = True
+  except SystemExit as e:
+    ok = e.code in [None, 0]
+  except Exception:
+    print(traceback.format_exc())
+    ok = False
+  finally:
+    sys.argv = argv
+    if nested is not None: gcmstoolbox.profile['nested'] = nested   # also if the command exited before stopProfile()
+  return ok
+
+
+
+def checkpoint():
+  # write the data files that were changed since the previous checkpoint
+  for path in gcmstoolbox.flushJSON():
+    print(" => Checkpoint: wrote " + os.path.relpath(path))
+
+
+
+if __name__ == "__main__":
+  main()
@@ -4,7 +4,9 @@
 import sys
 from optparse import OptionParser, OptionGroup
 from collections import OrderedDict
-from copy import deepcopy
+from array import array
+from math import sqrt
+from statistics import median
 import csv
 import gcmstoolbox
 
@@ -29,32 +31,33 @@ def main():
   parser.add_option("-v", "--verbose",  help="Be very verbose",  action="store_true", dest="verbose", default=False)
   parser.add_option("-i", "--jsonin",  help="JSON input file name [default: gcmstoolbox.json]", action="store", dest="jsonin", type="string", default="gcmstoolbox.json")
   parser.add_option("-o", "--jsonout", help="JSON output file name [default: same as JSON input file]", action="store", dest="jsonout", type="string")
-  parser.add_option("-g", "--groupby", help="Group measurements by categories (eg. Source, Sample, AAdays, Resin...)", action="store", dest="groupby", type="string", default="Source")
+  parser.add_option("-g", "--groupby", help="Group measurements by categories (eg. Source, Sample, AAdays, Resin...) [default: Source]; multiple instances (or comma separated) combine categories, eg. -g Resin -g AAdays", action="append", dest="groupby", type="string")
+  parser.add_option("-s", "--stats",   help="Statistics of the IS per component and category, comma separated: mean|median|std|cv|freq|norm [default: mean]; freq is the fraction of the sources of the category in which the component was detected, norm the mean IS divided by the average sum-IS of the category", action="store", dest="stats", type="string", default="mean")
 
+  gcmstoolbox.profileOptions(parser)
+  
   (options, args) = parser.parse_args()
   
 
   ### ARGUMENTS
 
   cmd = " ".join(sys.argv)
+  gcmstoolbox.startProfile(options, cmd)
 
   if options.verbose: print("Processing arguments...")
   
  # output file
   if len(args) == 0: #exit without complaining
     print("\n!! Needs a file name for the CSV report")
-    exit()
+    exit(1)
   elif len(args) == 1:
     outfile = args[0]
   else:
     print("\n!! Too many arguments")
-    exit()
+    exit(1)
   
   # check and read JSON input file
-  data = gcmstoolbox.openJSON(options.jsonin)
-  if data['info']['mode'] != "components":
-    print("\n!! Reports can only be generated if the components have been built.")
-    exit()
+  data = gcmstoolbox.openJSON(options.jsonin, options.jsonout)
 
   # json output 
   if options.jsonout == None: 
@@ -63,175 +66,247 @@ def main():
   if options.verbose:
     print(" => JSON input file:  " + options.jsonin)
     print(" => JSON output file: " + options.jsonout)
-    print(" => Output msp file:  " + mspfile + "\n")
+    print(" => Output CSV file:  " + outfile + "\n")
 
+  # group-by fields and statistics
+  if options.groupby is None:
+    options.groupby = ["Source"]
+  options.groupby = [field.strip() for g in options.groupby for field in g.split(",") if field.strip() != ""]
+  options.stats = [stat.strip().lower() for stat in options.stats.split(",") if stat.strip() != ""]
 
-  ### READ COMPONENTS
 
-  print("\nRunning through components...")
-  report = []
-
-  if not options.verbose: 
-    i = 0
-    j = len(data['components'])
-    gcmstoolbox.printProgress(i, j)
-  
-  for c in data['components']:
-    categories = OrderedDict()
-    component = data['components'][c]
+  ### MAKE REPORT
 
-    # check all spectra of a component and search for the group-by categories
-    for s in component['Spectra']: 
-      spectrum = data['spectra'][s]
+  # the rows are written to the report file as they are made; the first row is asked for before
+  # the file is opened, so that the checks of makereport do not leave an empty file
+  with gcmstoolbox.stage("report", len(data.get('components', [])), "components"):
+    rows = makereport(data, options.groupby, options.stats, verbose=options.verbose, progress=True)
+    try:
+      header = next(rows)
+    except gcmstoolbox.GCMSError as e:
+      print("\n!! " + str(e))
+      exit(1)
+    with open(outfile, 'w', newline='') as fh:
+      mkreport = csv.writer(fh, dialect='excel')
+      mkreport.writerow(header)
+      mkreport.writerows(rows)
+      
+  print("\n => Wrote {}\n".format(outfile))
 
-      # lookup category in spectrum (or default to unknown)
-      if options.groupby in spectrum:
-        cat = spectrum[options.groupby]
-      else:
-        cat = 'unknown'
+  ### TRACE IN JSON FILE
+  
+  # read-only command: the (possibly large) data file is not rewritten, the command is appended
+  # to its command history file instead; only a different JSON output file gets a full copy
+  if options.jsonout == options.jsonin:
+    print("\nPut a trace in the command history: " + options.jsonout + ".cmds\n")
+    gcmstoolbox.logCommand(options.jsonout, cmd)
+  else:
+    print("\nPut a trace in the JSON output file: " + options.jsonout + "\n")
+    data['info']['cmds'].append(cmd)                # put a trace in the data file
+    gcmstoolbox.saveJSON(data, options.jsonout)     # backup and safe json
 
-      # spectrumIS
-      if 'IS' in spectrum: spectrumIS = int(spectrum['IS'])
-      else:                spectrumIS = 1
+  gcmstoolbox.stopProfile()
+  exit()
+  
 
-      # store IS and count in categories
-      if cat not in categories:
-        categories[cat] = OrderedDict(
-          [('sumIS', spectrumIS), ('count', 1)]
-        )
-      else:
-        categories[cat]['sumIS'] += spectrumIS
-        categories[cat]['count'] += 1
 
-    # divide sumIS by the number of spectra
-    for cat in categories:
-      meanIS = categories[cat]['sumIS'] // categories[cat]['count'] #integer division!
-      categories[cat] = meanIS  # this is what we need to report, sumIS and count can thus be overwritten
 
-    # prepare report line for this component
-    reportline = [
-      "C" + component['DB#'],     # column A: component number
-      len(component['Spectra']),  # column B: number of spectra on which this group group/component was calculated
-      component['RI'],            # column C: component RI
-      component['dRI'],           # column D: RI difference within the component
-      categories                  # ordereddict with category -> mean intensities
-    ]                                                   
-    report.append(reportline)    
-    
-    # update progress bar
-    if options.verbose:
-      print("  - " + c)
-    else:
-      i += 1
-      gcmstoolbox.printProgress(i, j)
+def makereport(data, groupby=None, stats=None, verbose=False, progress=False):
+  # report of the IS of the components per category (combination of the groupby fields, default
+  # Source), with the given statistics (mean|median|std|cv|freq|norm, default mean); yields the
+  # rows of the report: 4 header rows and a row per component (progress: show the progress on the terminal)
+  if groupby is None: groupby = ["Source"]
+  if stats is None:   stats = ["mean"]
+  if data['info']['mode'] != "components":
+    raise gcmstoolbox.GCMSError("Reports can only be generated if the components have been built.")
+  for stat in stats:
+    if stat not in ["mean", "median", "std", "cv", "freq", "norm"]:
+      raise gcmstoolbox.GCMSError("Unknown statistic: " + stat + " (possible statistics are 'mean', 'median', 'std', 'cv', 'freq' and 'norm')")
 
+  bar = progress and not verbose   # progress bars
 
 
-  ### CALCULATE SUM-IS 
+  ### CATEGORIES OF THE SPECTRA
   
+  # one pass over the spectra: each spectrum gets an integer category code (for the combination of
+  # its group-by values) and its IS; at the same time the sum-IS, spectrum count and sources of each
+  # category are collected
   # the sum-IS is the sum of all spectra of a given source file
   # in case a category is composed of multiple source files, the sum-IS is a the average
   # (sum of the IS values of all spectra within this category, divided by the number of sources)
 
-  print("\nCalculate IS for each " + options.groupby + "...")
+  if progress or verbose: print("\nCalculate IS for each " + " x ".join(groupby) + "...")
 
-  if not options.verbose: 
+  if bar: 
     i = 0
     j = len(data['spectra'])
     gcmstoolbox.printProgress(i, j)
 
-  # compile a list of all group-by categories
-  categories = set()
-  for line in report:
-    categories.update(line[4].keys())
-  categories = sorted(categories) #convert to sorted list
-
-  # calculate sumIS and count for each category
-  catIS = dict()
-  catSpectra = dict()
-  catSources = dict()
-
-  for spectrum in data['spectra'].values():
-    if options.groupby in spectrum:
-      cat = spectrum[options.groupby]
-    else:
-      cat = 'unknown'
+  # the group-by values and the source of the spectra are coded as integers (-1: unknown)
+  fields = list(OrderedDict.fromkeys(groupby + ['Source']))
+  tables, spcodes = gcmstoolbox.categorycodes(data['spectra'], fields)
+  position = [fields.index(field) for field in groupby]
+  sourcefield = fields.index('Source')
+
+  codes = OrderedDict()   # category (tuple of group-by value codes) -> code
+  spindex = {}            # spectrum name -> index
+  spcat = array('l')      # index -> category code
+  spIS = array('q')       # index -> IS
+  spSource = array('l')   # index -> source code
+  catIS = []              # code -> summed IS
+  catSpectra = []         # code -> number of spectra
+  catSources = []         # code -> set of source codes
+
+  for (name, spectrum), spcode in zip(data['spectra'].items(), spcodes):
+    cat = tuple(spcode[p] for p in position)
+    source = spcode[sourcefield]
+    if cat not in codes:
+      codes[cat] = len(codes)
+      catIS.append(0)
+      catSpectra.append(0)
+      catSources.append(set())
+    code = codes[cat]
 
     # spectrumIS
     if 'IS' in spectrum: spectrumIS = int(spectrum['IS'])
     else:                spectrumIS = 1
 
-    # store IS and count in categories
-    if cat not in catIS:
-      catIS[cat] = spectrumIS
-      catSpectra[cat] = 1
-      catSources[cat] = set()
-    else:
-      catIS[cat] += spectrumIS
-      catSpectra[cat] += 1
-    catSources[cat].add(spectrum['Source'])
+    spindex[name] = len(spcat)
+    spcat.append(code)
+    spIS.append(spectrumIS)
+    spSource.append(source)
+    catIS[code] += spectrumIS
+    catSpectra[code] += 1
+    catSources[code].add(source)
 
     # update progress bar
-    if options.verbose:
-      print("  - S{}: category {} (#{})--> added {} to summed IS".format(spectrum['DB#'], cat, catSpectra[cat], spectrumIS))
-    else:
+    if verbose:
+      print("  - S{}: category {} (#{})--> added {} to summed IS".format(spectrum['DB#'], "/".join(categorylabel(cat, groupby, tables)), catSpectra[code], spectrumIS))
+    elif bar:
       i += 1
       gcmstoolbox.printProgress(i, j)
 
-  # calculate mean IS
-  for cat in categories:
-    # count sources per category
-    catSources[cat] = len(catSources[cat])
-    # calculate average sum-IS
-    catIS[cat] = catIS[cat] // catSources[cat]
 
+  ### PIVOT: SUM IS PER COMPONENT AND CATEGORY
+
+  if progress or verbose: print("\nRunning through components...")
+
+  if bar: 
+    i = 0
+    j = len(data['components'])
+    gcmstoolbox.printProgress(i, j)
+  
+  # the (component, category) cells are flat integer keys: component number * ncat + category code
+  # besides the summed IS and count, only what the chosen statistics need is collected
+  ncat = len(codes)
+  cellIS = {}
+  cellCount = {}
+  cellSquares = {} if ('std' in stats) or ('cv' in stats) else None   # summed IS**2
+  cellValues = {}  if ('median' in stats) else None                           # list of IS
+  cellSources = {} if ('freq' in stats) else None                             # set of sources
+  used = set()   # categories that occur in the components
+
+  for c, component in enumerate(data['components'].values()):
+    for s in component['Spectra']: 
+      k = spindex[s]
+      cell = c * ncat + spcat[k]
+      if cell in cellIS:
+        cellIS[cell] += spIS[k]
+        cellCount[cell] += 1
+      else:
+        cellIS[cell] = spIS[k]
+        cellCount[cell] = 1
+        used.add(spcat[k])
+        if cellSquares is not None: cellSquares[cell] = 0
+        if cellValues is not None:  cellValues[cell] = []
+        if cellSources is not None: cellSources[cell] = set()
+      if cellSquares is not None: cellSquares[cell] += spIS[k] * spIS[k]
+      if cellValues is not None:  cellValues[cell].append(spIS[k])
+      if cellSources is not None: cellSources[cell].add(spSource[k])
+    
+    # update progress bar
+    if verbose:
+      print("  - " + component['DB#'])
+    elif bar:
+      i += 1
+      gcmstoolbox.printProgress(i, j)
+
+  # the categories in the report (columns): sorted
+  categories = sorted((categorylabel(cat, groupby, tables), code) for cat, code in codes.items() if code in used)
+  columns = [code for cat, code in categories]
+  labels = ["/".join(cat) for cat, code in categories]
 
 
   ### MAKE REPORT
   
-  print("\nGenerating report...")
+  if progress or verbose: print("\nGenerating report...")
   
-  if not options.verbose: 
+  if bar: 
     i = 0
-    j = len(report)
+    j = len(data['components'])
     gcmstoolbox.printProgress(i, j)
     
-  # write report file
-  with open(outfile, 'w', newline='') as fh:
-    mkreport = csv.writer(fh, dialect='excel')
-
-    # write header rows
-    mkreport.writerow(["component",           "number of spectra", "RI", "dRI"] + categories)
-    mkreport.writerow(["(average sum-IS)",    "",                  "",   ""   ] + [catIS[cat]      for cat in categories])
-    mkreport.writerow(["(number of spectra)", "",                  "",   ""   ] + [catSpectra[cat] for cat in categories])
-    mkreport.writerow(["(number of sources)", "",                  "",   ""   ] + [catSources[cat] for cat in categories])
+  # one block of category columns for each statistic
+  if stats == ["mean"]:
+    header = labels
+  else:
+    header = [label + " [" + stat + "]" for stat in stats for label in labels]
+  blocks = len(stats)
+
+  # header rows (mean sum-IS: summed IS divided by the number of sources)
+  yield ["component",           "number of spectra", "RI", "dRI"] + header
+  yield ["(average sum-IS)",    "",                  "",   ""   ] + [catIS[code] // len(catSources[code]) for code in columns] * blocks
+  yield ["(number of spectra)", "",                  "",   ""   ] + [catSpectra[code] for code in columns] * blocks
+  yield ["(number of sources)", "",                  "",   ""   ] + [len(catSources[code]) for code in columns] * blocks
+  
+  # next rows: components, with the statistics of each category
+  for c, component in enumerate(data['components'].values()):
+    row = [
+      "C" + component['DB#'],     # column A: component number
+      len(component['Spectra']),  # column B: number of spectra on which this group group/component was calculated
+      component['RI'],            # column C: component RI
+      component['dRI']            # column D: RI difference within the component
+    ]
+    for stat in stats:
+      for code in columns:
+        cell = c * ncat + code
+        if cell in cellIS: row.append(cellstat(stat, cell, code, cellIS, cellCount, cellSquares, cellValues, cellSources, catIS, catSources))
+        else:              row.append("")
+    yield row
     
-    # next rows: components
-    for row in report:
-      # the last item in a report item (row) is a dict of categories and mean IS
-      # replace it with a complete and sorted list of mean IS'es
-      catIS = row.pop()
-      for cat in categories:
-        if cat in catIS: row.append(catIS[cat])
-        else:            row.append("")
-      # write row to report
-      mkreport.writerow(row)
-      
-      if not options.verbose: 
-        i += 1
-        gcmstoolbox.printProgress(i, j)
-      
-  print("\n => Wrote {}\n".format(outfile))
+    if bar: 
+      i += 1
+      gcmstoolbox.printProgress(i, j)
 
-  ### TRACE IN JSON FILE
-  
-  print("\nPut a trace in the JSON output file: " + options.jsonout + "\n")
-  data = gcmstoolbox.openJSON(options.jsonin)     # reread the file to be sure we haven't accidentally messed up the data
-  data['info']['cmds'].append(" ".join(sys.argv)) # put a trace in the data file
-  gcmstoolbox.saveJSON(data, options.jsonout)     # backup and safe json
 
-  exit()
-  
+
+def categorylabel(cat, groupby, tables):
+  # the group-by values of a category (a tuple of codes, see gcmstoolbox.categorycodes)
+  return tuple(tables[field][v] if v >= 0 else 'unknown' for field, v in zip(groupby, cat))
+
+
+
+def cellstat(stat, cell, code, cellIS, cellCount, cellSquares, cellValues, cellSources, catIS, catSources):
+  # statistic of the IS values in a (component, category) cell
+  n = cellCount[cell]
+  if stat == "mean":
+    return cellIS[cell] // n   #integer division!
+  elif stat == "median":
+    return median(cellValues[cell])
+  elif stat in ["std", "cv"]:
+    if n < 2: return ""
+    # sample standard deviation, from the (exact integer) sums
+    std = sqrt((n * cellSquares[cell] - cellIS[cell] ** 2) / (n * (n - 1)))
+    if stat == "std":       return round(std)
+    elif cellIS[cell] == 0: return ""
+    else:                   return round(std * n / cellIS[cell], 4)
+  elif stat == "freq":
+    return round(len(cellSources[cell]) / len(catSources[code]), 4)
+  elif stat == "norm":
+    average = catIS[code] / len(catSources[code])   # average sum-IS of the sources of the category
+    if average == 0: return ""
+    return "{:.6g}".format((cellIS[cell] / n) / average)
+
     
 if __name__ == "__main__":
   main()
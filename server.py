@@ -0,0 +1,213 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import io
+import hmac
+import pickle
+import secrets
+import shlex
+import threading
+import traceback
+import urllib.request
+import urllib.error
+from contextlib import redirect_stdout
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from optparse import OptionParser
+import gcmstoolbox
+import pipeline
+
+
+def main():
+  print("\n*******************************************************************************")
+  print(  "* GCMStoolbox - a set of tools for GC-MS data analysis                        *")
+  print(  "*   Version: {} ({})                                             *".format(gcmstoolbox.version, gcmstoolbox.date))
+  print(  "*   Author:  Wim Fremout, Royal Institute for Cultural Heritage               *")
+  print(  "*   Licence: GNU GPL version 3                                                *")
+  print(  "*                                                                             *")
+  print(  "* SERVER:                                                                     *")
+  print(  "*   keeps the data files in memory and runs GCMStoolbox commands sent to it   *")
+  print(  "*   over HTTP on localhost                                                    *")
+  print(  "*                                                                             *")
+  print(  "*******************************************************************************\n")
+
+
+  ### OPTIONPARSER
+
+  usage = "usage: %prog [options] [JSONFILE1 [JSONFILE2 [...]]]\n       %prog [options] -s COMMAND"
+
+  parser = OptionParser(usage, version="GCMStoolbox version " + gcmstoolbox.version + " (" + gcmstoolbox.date + ")\n")
+  parser.add_option("-p", "--port",  help="Port on localhost [default: 8765]", action="store", dest="port", type="int", default=8765)
+  parser.add_option("-d", "--delay", help="Seconds after a change before the data files are written [default: 10]", action="store", dest="delay", type="float", default=10)
+  parser.add_option("-s", "--send",  help="Send a command to a running server and print its output, eg. -s \"filter -i data.json make -c 3\"", action="store", dest="send", type="string")
+  parser.add_option("-t", "--token", help="File with the access token of the server, only readable by the user [default: ~/.gcmstoolbox-server-PORT]", action="store", dest="token", type="string")
+
+  (options, args) = parser.parse_args()
+  if options.token is None:
+    options.token = os.path.join(os.path.expanduser("~"), ".gcmstoolbox-server-{}".format(options.port))
+
+
+  ### CLIENT
+
+  if options.send is not None:
+    ok, output = send(options.send, options.port, options.token)
+    print(output)
+    exit(0 if ok else 1)
+
+
+  ### SERVER
+
+  # the data files stay in memory, and are loaded in advance if given
+  gcmstoolbox.keepJSON()
+  for jsonfile in args:
+    gcmstoolbox.openJSON(jsonfile)
+    print(" => Loaded " + jsonfile)
+
+  server = HTTPServer(("127.0.0.1", options.port), CommandHandler)
+  server.delay = options.delay
+  server.timer = None
+  # only clients that can read the token file (the user) can send commands
+  server.token = secrets.token_hex(16)
+  writetoken(options.token, server.token)
+  print("\nListening on http://127.0.0.1:{}/ (stop with Ctrl-C or the command 'stop')".format(options.port))
+  print("Commands: " + ", ".join(pipeline.commands) + ", save, status, stop\n")
+
+  try:
+    server.serve_forever()
+  except KeyboardInterrupt:
+    pass
+  finally:
+    if server.timer is not None: server.timer.cancel()
+    save()
+    server.server_close()
+    os.remove(options.token)
+
+
+
+# one command runs at a time, and the data files are not written while a command runs
+lock = threading.Lock()
+
+class CommandHandler(BaseHTTPRequestHandler):
+  # POST a command line (eg. "build -i data.json -s 5"), the response is the output of the command
+
+  def do_POST(self):
+    if not self.allowed():
+      self.send_response(403)
+      self.send_header("Content-Type", "text/plain; charset=utf-8")
+      self.end_headers()
+      self.wfile.write(b" !! Forbidden\n")
+      return
+    line = self.rfile.read(int(self.headers.get('Content-Length', 0))).decode("utf-8").strip()
+    ok, output = execute(line, self.server)
+    self.send_response(200 if ok else 400)
+    self.send_header("Content-Type", "text/plain; charset=utf-8")
+    self.end_headers()
+    self.wfile.write(output.encode("utf-8"))
+
+  def allowed(self):
+    # the request must carry the token of the server; requests of web pages (with an Origin
+    # header, or another host name, eg. by DNS rebinding) are refused
+    port = self.server.server_address[1]
+    if self.headers.get('Origin') is not None:
+      return False
+    if self.headers.get('Host') not in ["127.0.0.1:{}".format(port), "localhost:{}".format(port)]:
+      return False
+    return hmac.compare_digest(self.headers.get('X-GCMStoolbox-Token', ''), self.server.token)
+
+  def log_message(self, format, *args):
+    pass
+
+
+
+def execute(line, server):
+  # run a command line on the in-memory data files; returns success and the output
+  words = shlex.split(line)
+  if len(words) == 0:
+    return False, " !! No command given\n"
+  run = words[0].lower()
+  if run.endswith(".py"): run = run[:-3]
+  print(line)
+
+  if run == "save":
+    return True, "".join(" => Wrote " + path + "\n" for path in save())
+  elif run == "status":
+    return True, "".join("{} {}\n".format(path, "[unsaved]" if d[1] else "") for path, d in gcmstoolbox.datasets.items())
+  elif run == "stop":
+    threading.Thread(target=server.shutdown).start()
+    return True, " => Server stopped\n"
+  elif run not in pipeline.commands:
+    return False, " !! Unknown command '{}' (use {}, save, status or stop)\n".format(words[0], ", ".join(pipeline.commands))
+
+  output = io.StringIO()
+  with lock:
+    gcmstoolbox.touched = {}
+    try:
+      with redirect_stdout(output):
+        ok = pipeline.runstage(run, words[1:])
+    except Exception:
+      ok = False
+      output.write(traceback.format_exc())
+    # after a failed command, the data files it used may have been changed halfway: the ones
+    # with unsaved changes get their state before the command back, the others are dropped from
+    # memory and read again from disk
+    if not ok:
+      for path, snapshot in gcmstoolbox.touched.items():
+        if snapshot is not None:
+          gcmstoolbox.datasets[path] = [pickle.loads(snapshot), True]
+          output.write(" => Restored {} in memory as before this command\n".format(path))
+        elif path in gcmstoolbox.datasets:
+          del gcmstoolbox.datasets[path]
+          output.write(" => Dropped {} from memory (it is read again from disk)\n".format(path))
+    gcmstoolbox.touched = None
+
+  # write the changed data files in the background, after a delay without further changes
+  if any(d[1] for d in gcmstoolbox.datasets.values()):
+    if server.timer is not None: server.timer.cancel()
+    server.timer = threading.Timer(server.delay, save)
+    server.timer.daemon = True
+    server.timer.start()
+  return ok, output.getvalue()
+
+
+
+def save():
+  # write the unsaved data files; returns their file names
+  with lock:
+    written = gcmstoolbox.flushJSON()
+  for path in written:
+    print(" => Wrote " + path)
+  return written
+
+
+
+def writetoken(tokenfile, token):
+  # write the token in a file that only the user can read (0600)
+  fd = os.open(tokenfile, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+  os.chmod(tokenfile, 0o600)   # also if the file existed
+  with os.fdopen(fd, "w") as fh:
+    fh.write(token)
+
+
+
+def send(line, port=8765, tokenfile=None):
+  # send a command line to a running server, with the token of its token file; returns success and the output
+  if tokenfile is None:
+    tokenfile = os.path.join(os.path.expanduser("~"), ".gcmstoolbox-server-{}".format(port))
+  if not os.path.isfile(tokenfile):
+    return False, " !! No server on port {} (no token file {})\n".format(port, tokenfile)
+  with open(tokenfile, "r") as fh:
+    token = fh.read().strip()
+  request = urllib.request.Request("http://127.0.0.1:{}/".format(port), data=line.encode("utf-8"), method="POST",
+                                   headers={"X-GCMStoolbox-Token": token, "Content-Type": "text/plain; charset=utf-8"})
+  try:
+    with urllib.request.urlopen(request) as response:
+      return True, response.read().decode("utf-8")
+  except urllib.error.HTTPError as e:
+    return False, e.read().decode("utf-8")
+  except urllib.error.URLError as e:
+    return False, " !! No server on port {}: {}\n".format(port, e.reason)
+
+
+
+if __name__ == "__main__":
+  main()
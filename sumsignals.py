@@ -3,7 +3,10 @@
 
 import sys
 import os
+import re
 import csv
+import mmap
+import multiprocessing
 from glob import glob
 from optparse import OptionParser, OptionGroup
 import gcmstoolbox
@@ -31,12 +34,16 @@ def main():
   parser.add_option("-v", "--verbose", help="Be very verbose [not default]", action="store_true", dest="verbose", default=False)
   parser.add_option("-o", "--out",     help="CSV output file name [default: sumsignals.csv]", action="store", dest="outfile", type="string", default="sumsignals.csv")
   parser.add_option("--allmodels",     help="For AMDIS .ELU files: import all models [not default]", action="store_true", dest="allmodels", default=False)
+  parser.add_option("-j", "--jobs",    help="Number of parallel worker processes [default: 1]", action="store", dest="jobs", type="int", default=1)
+  
+  gcmstoolbox.profileOptions(parser)
   
   (options, args) = parser.parse_args()
 
   ### ARGUMENTS AND OPTIONS
   
   cmd = " ".join(sys.argv)
+  gcmstoolbox.startProfile(options, cmd)
   
   if options.verbose: print("Processing arguments and options")
 
@@ -44,28 +51,25 @@ def main():
   inFiles = []
   if len(args) == 0:
     print(" !! No ELU files?\n")
-    exit()
+    exit(1)
   else:
     for arg in args:
       inFiles.extend(glob(arg))
   inFiles = list(set(inFiles)) #remove duplicates
-  for inFile in inFiles:
-    if os.path.isdir(inFile):
-      inFiles.remove(inFile)   #remove directories
-    if (os.path.splitext(inFile)[1][1:].strip().upper() != 'ELU'):
-      inFiles.remove(inFile)
-    else:
-      if options.verbose: print(" - ELU file: " + inFile)
+  inFiles = [inFile for inFile in inFiles
+             if not os.path.isdir(inFile) and (os.path.splitext(inFile)[1][1:].strip().upper() == 'ELU')]  #only ELU files
+  if options.verbose:
+    for inFile in inFiles: print(" - ELU file: " + inFile)
 
   # number of inFiles; must not be 0
   numInFiles = len(inFiles)
   if numInFiles == 0:
     print(" !! No ELU files?\n")
-    exit()
+    exit(1)
   else:
     if options.verbose: print(" => " + str(numInFiles) + " ELU files")
 
-  if options.verbose: print(" => CSV output file: " + options.jsonout)
+  if options.verbose: print(" => CSV output file: " + options.outfile)
  
   
   ### ITERATE THROUGH INFILES
@@ -81,61 +85,77 @@ def main():
     gcmstoolbox.printProgress(j, k)
   
   # make report file
-  with open(options.outfile, 'w', newline='') as fho:
+  with gcmstoolbox.stage("scan", len(inFiles), "files"), open(options.outfile, 'w', newline='') as fho:
     mkreport = csv.writer(fho, dialect='excel')
-    mkreport.writerow(["Intgr.signal (IS)", "The area under the actual extracted component shape expressed in the units of the instrument it was acquired on"])
-    mkreport.writerow(["Area (XN)",         "This area is expressed in the units of the instrument that the component was acquired on and is computed by starting from the extracted component shape, but then using any baseline extension that seems reasonable to one or both sides of the actual extracted peak (Extra Width)"])
-    mkreport.writerow(["Base peak (AM)",    "The abundance of the most intense mass spectral peak in the deconvoluted spectrum"])
-    mkreport.writerow(["Amount (RA)",       "The area of the deconvoluted component (Area) relative to the total ion count for the entire chromatogram, expressed as a percentage"])
-    mkreport.writerow("")
-    mkreport.writerow(["ELU file", "spectra count", "sum of Integr.signals", "sum of Areas", "sum of Base peaks", "sum of Amounts"])
+    gcmstoolbox.sumsignalsHeader(mkreport)
   
-    # process ELU files one by one
-    for inFile in inFiles:
-      
-      # init
-      totIS = 0
-      totXN = 0
-      totAM = 0
-      totRA = 0
-      toti = 0
-      
-      # process spectra in a ELU file
-      with open(inFile,'r') as fhi:   #file handle closes itself 
-        for line in fhi:
-          if line.casefold().startswith('name'):
-            parts = line.split('|')
-            for p in parts:
-              if   p.startswith('IS'): specIS = int(p[2:])
-              elif p.startswith('XN'): specXN = int(p[2:])
-              elif p.startswith('AM'): specAM = int(p[2:])
-              elif p.startswith('RA'): specRA = float(p[2:])
-              elif p.startswith('OR'): specOR = int(p[2:])  # order number of Amdis models (starts with 1)
-            
-            if (specOR == 1) or options.allmodels:
-              totIS += specIS
-              totXN += specXN
-              totAM += specAM
-              totRA += specRA
-              toti += 1
-            
-      # add report line
-      mkreport.writerow([os.path.basename(inFile), toti, totIS, totXN, totAM, "{0:.6f}".format(totRA)])
+    # process ELU files (in worker processes if --jobs); imap returns them in order
+    if options.jobs > 1:
+      pool = multiprocessing.Pool(options.jobs)
+      results = pool.imap(scanworker, [(inFile, options.allmodels) for inFile in inFiles])
+    else:
+      pool = None
+      results = (scanelu(inFile, options.allmodels) for inFile in inFiles)
+    
+    try:
+      for inFile, (toti, totIS, totXN, totAM, totRA) in zip(inFiles, results):
+        # add report line
+        mkreport.writerow(gcmstoolbox.sumsignalsRow(os.path.basename(inFile), toti, totIS, totXN, totAM, totRA))
             
-      # adjust progress bar
-      if options.verbose: 
-        print(", ".join([os.path.basename(inFile), str(toti), str(totIS), str(totXN), str(totAM), "{0:.6f}".format(totRA)]))
-      else:
-        j += 1
-        gcmstoolbox.printProgress(j, k)      
+        # adjust progress bar
+        if options.verbose: 
+          print(", ".join([os.path.basename(inFile), str(toti), str(totIS), str(totXN), str(totAM), "{0:.6f}".format(totRA)]))
+        else:
+          j += 1
+          gcmstoolbox.printProgress(j, k)      
+    
+    finally:
+      if pool is not None:
+        pool.close()
+        pool.join()
         
         
   ### WRITE SPECTRA JSON 
   
   print("\n => Finalised. Wrote " + options.outfile + "\n")
+  gcmstoolbox.stopProfile()
   exit()
 
 
 
+# ELU header lines ("NAME: |SC15|CN2|...|AM25664|...|RA0.00403|IS394917|XN425813|...|OR1|NT1")
+# and the fields we need from them
+namepattern = re.compile(rb"^name:([^\r\n]*)", re.IGNORECASE | re.MULTILINE)
+fieldpattern = re.compile(rb"\|(IS|XN|AM|RA|OR)([^|\r\n]*)")
+
+def scanelu(inFile, allmodels=False):
+  # sums IS, XN, AM and RA of the spectra in an ELU file: returns count, IS, XN, AM, RA
+  # only the NAME lines are parsed: the file is memory-mapped and searched for them, 
+  # skipping the peak data in between; without allmodels, only the first Amdis model (OR1) is counted
+  toti = totIS = totXN = totAM = 0
+  totRA = 0.0
+  
+  with open(inFile, 'rb') as fh:
+    if os.fstat(fh.fileno()).st_size == 0:
+      return toti, totIS, totXN, totAM, totRA
+    with mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+      for name in namepattern.finditer(mm):
+        fields = dict(fieldpattern.findall(name.group(1)))
+        if allmodels or (int(fields.get(b'OR', 1)) == 1):   # order number of Amdis models (starts with 1)
+          totIS += int(fields.get(b'IS', 0))
+          totXN += int(fields.get(b'XN', 0))
+          totAM += int(fields.get(b'AM', 0))
+          totRA += float(fields.get(b'RA', 0))
+          toti += 1
+  
+  return toti, totIS, totXN, totAM, totRA
+
+
+
+def scanworker(task):
+  return scanelu(*task)
+
+
+
 if __name__ == "__main__":
   main()
@@ -0,0 +1,227 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# tests of the library functions of the tools, on a synthetic dataset (see benchmark.generate)
+# run with: python -m pytest tests
+
+import os
+import sys
+import importlib
+from collections import OrderedDict
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import gcmstoolbox
+import benchmark
+import group
+import filter
+import build
+import export
+import report
+import nist2txt
+
+imp = importlib.import_module("import")    # importlib, as "import" cannot be imported otherwise
+
+spectra = 2000
+
+
+@pytest.fixture(scope="module")
+def dataset(tmp_path_factory):
+  # the synthetic dataset, imported, grouped, filtered (F1: at least 3 spectra) and built
+  workdir = str(tmp_path_factory.mktemp("dataset"))
+  truth = benchmark.generate(workdir, spectra)
+  files = sorted(os.path.join(workdir, "data", fn) for fn in truth)
+  data = imp.newdata()
+  imported = imp.importspectra(data, files, elinc=True)
+  hitsfile = os.path.join(workdir, "hits.txt")
+  benchmark.writehits(hitsfile, data, truth)
+  group.groupspectra(data, hitsfile, rifixed=5)
+  filter.makefilter(data, count=3)
+  build.buildcomponents(data)
+  return OrderedDict([('workdir', workdir), ('truth', truth), ('files', files), ('imported', imported), ('data', data)])
+
+
+
+### IMPORT
+
+def test_importspectra(dataset):
+  data = dataset['data']
+  assert dataset['imported'] == spectra
+  assert len(data['spectra']) == spectra
+  assert [sp['DB#'] for sp in data['spectra'].values()] == [str(i) for i in range(1, spectra + 1)]
+  # each file is imported in order, with the metadata of its (ELinC) file name
+  sources = [sp['Source'] for sp in data['spectra'].values()]
+  assert sources == [os.path.basename(fn) for fn in dataset['files'] for k in dataset['truth'][os.path.basename(fn)]]
+  for sp in data['spectra'].values():
+    assert sp['Resin'] in gcmstoolbox.resin.values()
+    assert sp['PyTemp'] in ["480", "600"]
+
+
+def test_importspectra_mode():
+  data = imp.newdata()
+  data['info']['mode'] = "components"
+  with pytest.raises(gcmstoolbox.GCMSError):
+    imp.importspectra(data, [])
+
+
+
+### GROUP
+
+def test_groupspectra(dataset):
+  data = dataset['data']
+  members = [s for g in data['groups'].values() for s in g['spectra']]
+  assert sorted(members) == sorted(data['spectra'])
+  for g in data['groups'].values():
+    assert g['count'] == len(g['spectra'])
+    assert 1 <= g['sources'] <= g['count']
+    assert 1 <= g['samples'] <= g['count']
+
+  # a group holds spectra of one generated component (the spectra of a file are imported in order)
+  ordinal = {}
+  component = {}
+  for name, sp in data['spectra'].items():
+    k = ordinal.get(sp['Source'], 0)
+    ordinal[sp['Source']] = k + 1
+    component[name] = dataset['truth'][sp['Source']][k]
+  for g in data['groups'].values():
+    assert len(set(component[s] for s in g['spectra'])) == 1
+
+
+
+### FILTER
+
+def test_makefilter(dataset):
+  data = dataset['data']
+  assert data['filters']['F1']['active']
+  assert set(data['filters']['F1']['out']) == set(g for g, v in data['groups'].items() if v['count'] < 3)
+
+
+def test_makefilter_sourcecount(dataset):
+  data = dataset['data']
+  name = filter.makefilter(data, count=20, sourcecount=True)
+  try:
+    assert set(data['filters'][name]['out']) == set(g for g, v in data['groups'].items() if v['sources'] < 20)
+  finally:
+    del data['filters'][name]
+
+
+def test_makefilter_criteria(dataset):
+  with pytest.raises(gcmstoolbox.GCMSError):
+    filter.makefilter(dataset['data'])
+
+
+
+### BUILD
+
+def test_buildcomponents(dataset):
+  data = dataset['data']
+  out = set(data['filters']['F1']['out'])
+  assert len(data['components']) == len(data['groups']) - len(out)
+  ris = []
+  for c, (name, sp) in enumerate(data['components'].items(), 1):
+    assert sp['DB#'] == str(c)
+    assert sp['Group'] not in out
+    assert sp['Spectra'] == data['groups'][sp['Group']]['spectra']
+    assert sp['Source'] == sorted(set(data['spectra'][s]['Source'] for s in sp['Spectra']))
+    ris.append(data['groups'][sp['Group']]['minRI'])
+  assert ris == sorted(ris)
+
+
+def test_buildcomponents_fastpaths(dataset):
+  # parallel and incremental builds give the same components
+  data = dataset['data']
+  components = data['components']
+  build.buildcomponents(data, jobs=2)
+  assert data['components'] == components
+  assert build.buildcomponents(data, incremental=True) == len(components)
+  assert data['components'] == components
+
+
+
+### EXPORT
+
+def test_exportlist(dataset):
+  data = dataset['data']
+  mode, splist = export.exportlist(data)
+  assert mode == "components"
+  assert splist is data['components']
+  g = data['components'][next(iter(data['components']))]['Group']
+  mode, splist = export.exportlist(data, "group", [g[1:]])
+  assert mode == "group"
+  assert list(splist) == data['groups'][g]['spectra'] + [next(iter(data['components']))]
+
+
+def test_writemsp(dataset, tmp_path):
+  data = dataset['data']
+  mspfile = str(tmp_path / "components.msp")
+  export.writemsp(mspfile, data['components'])
+  with open(mspfile, "r") as fh:
+    text = fh.read()
+  assert text.count("Name: ") == len(data['components'])
+  assert text.count("\n\n") == len(data['components'])
+  # the worker processes write the same file (the records carry the file name)
+  export.writemsp(str(tmp_path / "jobs.msp"), data['components'], jobs=2)
+  with open(str(tmp_path / "jobs.msp"), "r") as fh:
+    assert fh.read().replace("jobs", "components") == text
+
+
+
+### REPORT
+
+def test_makereport(dataset):
+  data = dataset['data']
+  rows = list(report.makereport(data, stats=["mean", "cv", "freq", "norm"]))
+  sources = sorted(set(sp['Source'] for sp in data['spectra'].values()))
+  assert len(rows) == 4 + len(data['components'])
+  assert rows[0][4:] == [source + " [" + stat + "]" for stat in ["mean", "cv", "freq", "norm"] for source in sources]
+  assert rows[2][4:4 + len(sources)] == [sum(1 for sp in data['spectra'].values() if sp['Source'] == source) for source in sources]
+
+
+def test_makereport_zero(dataset):
+  # no division by zero in the cv and norm statistics if the IS values are 0
+  data = dataset['data']
+  zero = OrderedDict(data)
+  zero['spectra'] = OrderedDict((name, dict(sp, IS="0")) for name, sp in data['spectra'].items())
+  rows = list(report.makereport(zero, stats=["cv", "norm"]))
+  for row in rows[4:]:
+    assert all(value == "" for value in row[4:])
+
+
+def test_makereport_mode():
+  data = imp.newdata()
+  with pytest.raises(gcmstoolbox.GCMSError):
+    list(report.makereport(data))
+
+
+
+### NIST2TXT SEARCH
+
+@pytest.fixture
+def index(tmp_path):
+  nistfile = tmp_path / "library.msp"
+  nistfile.write_text("NAME: Benzene\nCAS#: 71-43-2\nRI: 650\nNum Peaks: 1\n78 999;\n\n"
+                      "NAME: 1,2-Dichlorobenzene\nCAS#: 95-50-1\nRI: 1035\nNum Peaks: 1\n146 999;\n\n"
+                      "NAME: Toluene\nCAS#: 108-88-3\nRI: 760.5\nNum Peaks: 1\n91 999;\n\n")
+  return nist2txt.makeindex(str(nistfile))
+
+
+def test_search(index):
+  offsets = [record[0] for record in index['records']]
+  assert nist2txt.search(index, name="benzene") == offsets[0:2]
+  assert nist2txt.search(index, name="zene") == offsets[0:2]
+  assert nist2txt.search(index, name="2-dichloro") == offsets[1:2]
+  assert nist2txt.search(index, name="benzene toluene") == []
+  assert nist2txt.search(index, cas="108-88-3") == offsets[2:3]
+  assert nist2txt.search(index, ri="760") == offsets[2:3]
+  assert nist2txt.search(index, ri="600-1100") == offsets
+  assert nist2txt.search(index, name="benzene", ri="1000-1100") == offsets[1:2]
+
+
+def test_rirange():
+  assert nist2txt.rirange("1200") == (1199.5, 1200.5)
+  assert nist2txt.rirange("1200-1250") == (1200, 1250)
+  for ri in ["abc", "1200-", "-"]:
+    with pytest.raises(ValueError):
+      nist2txt.rirange(ri)